@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""Benchmark taglib decode, dump and save speed.
+
+Every file in the sample directory is decoded, dumped (once per id3v2
+version for mp3-based formats) and saved to a scratch copy.  Synthetic
+files are then generated to stress the slow paths: a long mp3 stream
+(use -m 500 for the 500MB case), an ogg file with many pages, a tag
+with large embedded artwork and an m4a file with many nested atoms.
+Results are written as JSON, and a previous run can be given with -c to
+report regressions.
+"""
+
+from __future__ import with_statement
+from optparse import OptionParser
+from timeit import default_timer as timer
+import logging as log
+import tempfile
+import shutil
+import struct
+import json
+import time
+import sys
+import os
+
+sys.dont_write_bytecode = True  # DOWN WITH PYC
+
+from taglib import (tagopen, InvalidMedia, TaglibError, __version__, MP3,
+                    OGG, PIL)
+
+if PIL:
+    from PIL import Image
+
+# initialize root logger
+log.basicConfig(level=log.INFO, format='%(levelname)s> %(message)s')
+
+REPEAT = 3
+THRESHOLD = 1.25
+MP3_SIZE = 64
+OGG_PAGES = 10000
+ART_SIZE = 5
+M4A_ATOMS = 10000
+M4A_DEPTH = 256
+CRC_SIZE = 1048576
+
+MP3_FRAME = '\xff\xfb\x90\x64' + '\x00' * 413
+MP3_TEMPLATE = 'sample2.mp3'
+OGG_TEMPLATE = 'sample.ogg'
+
+Skipped = TaglibError, NotImplementedError, EnvironmentError
+
+
+def find(dir):
+    """Yields full path to files in a directory"""
+    for basedir, subdirs, filenames in os.walk(dir):
+        subdirs.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(basedir, filename)
+
+
+def measure(func, repeat, setup=None):
+    """Run func repeat times and return best and mean wall-clock time"""
+    times = []
+    for i in xrange(repeat):
+        if setup is None:
+            start = timer()
+            func()
+        else:
+            arg = setup()
+            start = timer()
+            func(arg)
+        times.append(timer() - start)
+    return min(times), sum(times) / len(times)
+
+
+def result(name, info, func, repeat, setup=None):
+    """Time one benchmark and return its record, or None if unsupported"""
+    try:
+        best, mean = measure(func, repeat, setup)
+    except Skipped, error:
+        log.debug('%s %s skipped: %s' % (name, info['file'], error))
+        return
+    log.info('%-14s %-24s %10.6f' % (name, info['file'], best))
+    record = dict(info, name=name, repeat=repeat, best=best, mean=mean)
+    if info['size']:
+        record['rate'] = info['size'] / best if best else None
+    return record
+
+
+def bench_file(file, repeat, tmpdir, name=None):
+    """Yield decode, dump and save results for a single file"""
+    if name is None:
+        name = os.path.basename(file)
+    try:
+        tag = tagopen(file)
+    except InvalidMedia:
+        log.warn('%s: could not decode' % name)
+        return
+    info = {'file': name, 'format': tag.format,
+            'size': os.path.getsize(file)}
+    yield result('decode', info, lambda: tagopen(file), repeat)
+    yield result('decode_headers', info,
+                 lambda: tagopen(file, scan_audio=False), repeat)
+    if not tag.editable:
+        return
+    if isinstance(tag, MP3):
+        for version in 2, 3, 4:
+            yield result('dump_v%d' % version, info,
+                         lambda version=version: tag.dump(os.devnull,
+                                                          version=version),
+                         repeat)
+    else:
+        yield result('dump', info, lambda: tag.dump(os.devnull), repeat)
+    copy = os.path.join(tmpdir, 'save' + os.path.splitext(file)[1])
+
+    def setup():
+        shutil.copyfile(file, copy)
+        return tagopen(copy)
+
+    yield result('save', info, lambda tag: tag.save(), repeat, setup)
+
+
+def bench_mp3frames(file, repeat, name):
+    """Yield frame index and frame iteration results for an mp3"""
+    tag = tagopen(file)
+    info = {'file': name, 'format': tag.format,
+            'size': os.path.getsize(file)}
+    yield result('mp3index', info, lambda: tag.mp3index, repeat)
+    yield result('mp3frames', info,
+                 lambda: sum(len(frame) for frame in tag.mp3frames), repeat)
+
+
+def bench_crc(repeat, size=CRC_SIZE):
+    """Yield ogg checksum result for a block of data"""
+    data = os.urandom(size)
+    info = {'file': '<%d bytes>' % size, 'format': 'crc', 'size': size}
+    yield result('crc', info, lambda: OGG.crc.checksum(data), repeat)
+
+
+def template(samples, name):
+    """Return tag for a sample used to seed a synthetic file"""
+    path = os.path.join(samples, name)
+    try:
+        return tagopen(path)
+    except (InvalidMedia, EnvironmentError):
+        log.warn('%s: template missing, skipping' % path)
+
+
+def make_mp3(dir, samples, size):
+    """Long mp3 stream of size megabytes between sample tags"""
+    tag = template(samples, MP3_TEMPLATE)
+    if tag is None:
+        return
+    path = os.path.join(dir, 'long.mp3')
+    count = size * 1048576 // len(MP3_FRAME)
+    chunk = MP3_FRAME * 2048
+    with open(path, 'wb') as fp:
+        tag.encode(fp, domp3=False, doid3v1=False)
+        for i in xrange(count // 2048):
+            fp.write(chunk)
+        fp.write(MP3_FRAME * (count % 2048))
+        tag.encode(fp, doid3v2=False, domp3=False)
+    return path
+
+
+def make_artwork(dir, samples, size):
+    """Sample mp3 carrying an embedded png of roughly size megabytes"""
+    if not PIL:
+        log.warn('PIL not installed, skipping artwork')
+        return
+    tag = template(samples, MP3_TEMPLATE)
+    if tag is None:
+        return
+    width = 1024
+    height = size * 1048576 // (width * 3)
+    frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+    image = frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    art = os.path.join(dir, 'art.png')
+    image.save(art, 'PNG')
+    tag.image = art
+    path = os.path.join(dir, 'art.mp3')
+    tag.dump(path)
+    return path
+
+
+def make_ogg(dir, samples, pages):
+    """Sample ogg with its last audio page repeated pages times"""
+    if template(samples, OGG_TEMPLATE) is None:
+        return
+    with open(os.path.join(samples, OGG_TEMPLATE), 'rb') as fp:
+        data = fp.read()
+    found = []
+    pos = 0
+    while pos < len(data):
+        head = list(OGG.head.unpack_from(data, pos))
+        start = pos + OGG.head.size
+        pos = start + head[7] + sum(map(ord, data[start:start + head[7]]))
+        found.append((head, data[start:pos]))
+    head, body = found.pop()
+    granule = head[3]
+    path = os.path.join(dir, 'pages.ogg')
+    with open(path, 'wb') as fp:
+        for page in found:
+            fp.write(OGG.head.pack(*page[0]) + page[1])
+        for i in xrange(pages):
+            head[2] = 4 if i == pages - 1 else 0
+            head[3] = granule * (i + 1)
+            head[5] = len(found) + i
+            head[6] = 0
+            head[6] = OGG.crc.checksum(OGG.head.pack(*head), body)
+            fp.write(OGG.head.pack(*head) + body)
+    return path
+
+
+def make_m4a(dir, count, depth):
+    """M4A with count metadata atoms and depth levels of nested atoms"""
+    atom = lambda id, data: struct.pack('> L 4s', len(data) + 8, id) + data
+    text = lambda id, val: atom(id, atom('data', struct.pack('> 2L', 1, 0) +
+                                         val))
+    ids = ['\xa9nam', '\xa9ART', '\xa9alb', '\xa9cmt', '\xa9too', 'xxxx']
+    items = [text(ids[i % len(ids)], 'item %d' % i) for i in xrange(count)]
+    nested = atom('free', '')
+    for i in xrange(depth):
+        nested = atom('trak' if i % 2 else 'mdia', nested)
+    meta = atom('meta', '\x00' * 4 + atom('ilst', ''.join(items)))
+    path = os.path.join(dir, 'atoms.m4a')
+    with open(path, 'wb') as fp:
+        fp.write(atom('ftyp', 'M4A \x00\x00\x00\x00M4A mp42isom'))
+        fp.write(atom('moov', nested + atom('udta', meta)))
+        fp.write(atom('mdat', '\x00' * 1024))
+    return path
+
+
+def compare(old, new, threshold):
+    """Log benchmarks slower than threshold times the old run"""
+    key = lambda record: (record['name'], record['file'])
+    baseline = dict((key(record), record) for record in old['results'])
+    regressions = 0
+    for record in new['results']:
+        try:
+            ratio = record['best'] / baseline[key(record)]['best']
+        except (KeyError, ZeroDivisionError):
+            continue
+        record['ratio'] = ratio
+        if ratio > threshold:
+            regressions += 1
+            log.warn('regression: %s %s is %.2fx slower' % (
+                record['name'], record['file'], ratio))
+    return regressions
+
+
+def main(args=None):
+    """Command-line interface"""
+    optparse = OptionParser('%prog [opts] [samples]', version=__version__,
+                            description=__doc__)
+    optparse.add_option('-o', dest='output', metavar='<file>',
+                        help='write JSON results to <file> (default stdout)')
+    optparse.add_option('-c', dest='compare', metavar='<file>',
+                        help='compare against JSON results in <file>')
+    optparse.add_option('-t', dest='threshold', metavar='<ratio>',
+                        type='float', default=THRESHOLD,
+                        help='slowdown reported as regression (default: '
+                        '%default)')
+    optparse.add_option('-r', dest='repeat', metavar='<n>', type='int',
+                        default=REPEAT,
+                        help='runs per benchmark (default: %default)')
+    optparse.add_option('-m', dest='mp3size', metavar='<mb>', type='int',
+                        default=MP3_SIZE,
+                        help='synthetic mp3 size (default: %default)')
+    optparse.add_option('-p', dest='pages', metavar='<n>', type='int',
+                        default=OGG_PAGES,
+                        help='synthetic ogg pages (default: %default)')
+    optparse.add_option('-a', dest='artsize', metavar='<mb>', type='int',
+                        default=ART_SIZE,
+                        help='synthetic artwork size (default: %default)')
+    optparse.add_option('-n', dest='atoms', metavar='<n>', type='int',
+                        default=M4A_ATOMS,
+                        help='synthetic m4a atoms (default: %default)')
+    optparse.add_option('-d', dest='depth', metavar='<n>', type='int',
+                        default=M4A_DEPTH,
+                        help='synthetic m4a nesting (default: %default)')
+    optparse.add_option('-S', dest='synthetic', default=True,
+                        action='store_false', help='skip synthetic files')
+    optparse.add_option('-k', dest='keep', default=False,
+                        action='store_true', help='keep synthetic files')
+    opts, args = optparse.parse_args(args)
+    if len(args) > 1:
+        optparse.print_help()
+        return 1
+    if args:
+        samples = args[0]
+    else:
+        samples = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'samples')
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='taglib-bench-')
+    log.info('begin at %s' % time.ctime())
+    try:
+        for file in find(samples):
+            results.extend(bench_file(file, opts.repeat, tmpdir))
+        results.extend(bench_crc(opts.repeat))
+        if opts.synthetic:
+            log.info('generating synthetic files in %s' % tmpdir)
+            path = make_mp3(tmpdir, samples, opts.mp3size)
+            if path:
+                name = 'synthetic/%dmb.mp3' % opts.mp3size
+                results.extend(bench_file(path, opts.repeat, tmpdir, name))
+                results.extend(bench_mp3frames(path, opts.repeat, name))
+            path = make_artwork(tmpdir, samples, opts.artsize)
+            if path:
+                name = 'synthetic/%dmb-art.mp3' % opts.artsize
+                results.extend(bench_file(path, opts.repeat, tmpdir, name))
+            path = make_ogg(tmpdir, samples, opts.pages)
+            if path:
+                name = 'synthetic/%dpages.ogg' % opts.pages
+                results.extend(bench_file(path, opts.repeat, tmpdir, name))
+            path = make_m4a(tmpdir, opts.atoms, opts.depth)
+            name = 'synthetic/%datoms.m4a' % opts.atoms
+            results.extend(bench_file(path, opts.repeat, tmpdir, name))
+    except KeyboardInterrupt:
+        log.error('user cancelled benchmark')
+        return 2
+    finally:
+        if opts.keep:
+            log.info('synthetic files kept in %s' % tmpdir)
+        else:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    report = {'version': __version__,
+              'python': sys.version.split()[0],
+              'platform': sys.platform,
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'repeat': opts.repeat,
+              'results': [record for record in results if record]}
+    regressions = 0
+    if opts.compare:
+        with open(opts.compare, 'rb') as fp:
+            regressions = compare(json.load(fp), report, opts.threshold)
+        log.info('Regressions: %d' % regressions)
+    if opts.output:
+        with open(opts.output, 'wb') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        log.info('wrote %s' % opts.output)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if regressions:
+        return 3
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
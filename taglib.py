@@ -44,8 +44,15 @@ if sys.hexversion < 0x02060200:
     sys.exit(0)
 
 from struct import error as StructError, Struct
-from collections import MutableMapping
+from collections import Mapping, MutableMapping
+from abc import ABCMeta
+from multiprocessing import Pool, cpu_count
+from itertools import imap
+from array import array
+from mmap import mmap as MemoryMap, ACCESS_READ
+from tempfile import TemporaryFile, mkstemp
 from math import log
+import time
 import os
 import re
 
@@ -54,6 +61,21 @@ try:
 except ImportError:
     from StringIO import StringIO
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
 try:
     from PIL import Image
     from PIL.ImageFile import ImageFile
@@ -63,15 +85,23 @@ except ImportError:
 
 __version__ = '3.1'
 __author__ = 'Chris Jones <cjones@gruntle.org>'
-__all__ = ['tagopen', 'InvalidMedia', 'ValidationError']
+__all__ = ['tagopen', 'scan', 'Padding', 'InvalidMedia', 'ValidationError']
 
 DEFAULT_ID3V2_VERSION = 2
 DEFAULT_PADDING = 128
+REWRITE_PERCENT = 10
 MP3_SAMPLESIZE = 5762
+MP3_SCANSIZE = 65536
+ID3V2_READSIZE = 65536
+VORBIS_KEYSIZE = 64
 ANYITEM = -1
 GAPLESS = u'iTunPGAP'
 ENCODING = sys.getfilesystemencoding()
 BLOCKSIZE = 4096
+COPYSIZE = 1048576
+SCAN_CHUNKSIZE = 64
+CACHE_MAXSIZE = 1000000
+CACHE_BATCHSIZE = 1000
 
 (DICT, IDICT, TEXT, UINT16, BOOL, UINT16X2,
  GENRE, IMAGE, UINT32, VOLUME) = xrange(10)
@@ -178,8 +208,16 @@ GENRES = ['Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk',
 BOOLEANS = {True: ['true', 't', 'yes', 'y', 'on', '1', 1, '\x01'],
             False: ['false', 'f', 'no', 'n', 'off', '0', 0]}
 
+BOOLEAN_VALUES = dict((val, bool) for bool, vals in BOOLEANS.iteritems()
+                      for val in vals)
+
 ID3V1_ATTRS = ['name', 'artist', 'album', 'year', 'comment', 'track', 'genre']
 
+FIELD_SOURCES = {'comment': '_comment',
+                 'gapless': '_comment',
+                 'image': '_image',
+                 'lyrics': '_lyrics'}
+
 ID3V2_OPTS = {2: {'head': Struct('3s 3s 0s'),
                   'syncsafe': False,
                   'tags': {'COM': '_comment',
@@ -259,6 +297,22 @@ ID3V2_OPTS = {2: {'head': Struct('3s 3s 0s'),
 ID3V2_TAGS = dict((tag, attr) for opts in ID3V2_OPTS.itervalues()
                   for tag, attr in opts['tags'].iteritems())
 
+ID3V2_FRAMEIDS = frozenset(ID3V2_TAGS)
+ID3V2_IDCHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 '
+ID3V2_SYNCSAFE = [[(byte & 0x7f) << shift for byte in xrange(256)]
+                  for shift in (21, 14, 7, 0)]
+
+IMAGE_MIMETYPES = {'BMP': 'image/bmp',
+                   'GIF': 'image/gif',
+                   'JPG': 'image/jpeg',
+                   'PNG': 'image/png'}
+
+IMAGE_FORMATS = {'image/bmp': 'BMP',
+                 'image/gif': 'GIF',
+                 'image/jpeg': 'JPEG',
+                 'image/jpg': 'JPEG',
+                 'image/png': 'PNG'}
+
 ID3V2_ENCODINGS = {'\x00': ('latin-1', '\x00'),
                    '\x01': ('utf-16', '\x00\x00'),
                    '\x02': ('utf-16-be', '\x00\x00'),
@@ -416,31 +470,55 @@ class InvalidMedia(TaglibError):
     pass
 
 
+class ContainerType(ABCMeta):
+
+    def __init__(cls, name, bases, attrs):
+        super(ContainerType, cls).__init__(name, bases, attrs)
+        for attr in cls.types:
+            if not hasattr(cls, attr):
+                setattr(cls, attr, None)
+        cls.order = tuple(sorted(attr for attr in cls.types
+                                 if not attr.startswith('_')))
+        cls.dynamic = frozenset(attr for attr in cls.order
+                                if isinstance(getattr(cls, attr), property))
+        cls.typevalidators = dict((type, cls.validator(type))
+                                  for type in set(cls.types.itervalues()))
+        cls.validators = dict((attr, cls.typevalidators[type])
+                              for attr, type in cls.types.iteritems())
+
+
 class Container(MutableMapping):
 
+    __metaclass__ = ContainerType
     types = {}
 
+    def __new__(cls, *args, **kwargs):
+        self = super(Container, cls).__new__(cls)
+        self.__dict__['_filled'] = set()
+        self.__dict__['_ordered'] = None
+        return self
+
     def __init__(self, *args, **kwargs):
         self.__dict__.update(*args, **kwargs)
+        for attr in self.order:
+            self._fill(attr, self.__dict__.get(attr))
 
     def getdisplay(self, attr):
         return repr(self[attr])
 
     def __getitem__(self, key):
-        return self.__getattribute__(key)
-
-    def __getattribute__(self, attr):
-        try:
-            return super(Container, self).__getattribute__(attr)
-        except AttributeError:
-            if attr not in self.types:
-                raise
+        return getattr(self, key)
 
     def __setitem__(self, key, val):
         self.__setattr__(key, val)
 
     def __setattr__(self, attr, val):
-        super(Container, self).__setattr__(attr, self._validate(attr, val))
+        if attr in self.types:
+            val = self._validate(attr, val)
+            super(Container, self).__setattr__(attr, val)
+            self._fill(attr, val)
+        else:
+            super(Container, self).__setattr__(attr, val)
 
     def __delitem__(self, key):
         self.__delattr__(key)
@@ -452,13 +530,37 @@ class Container(MutableMapping):
         except AttributeError:
             if attr not in self.types:
                 raise
+        self._fill(attr, None)
 
     def __iter__(self):
-        return (attr for attr in sorted(self.types)
-                if not attr.startswith('_') and self[attr] is not None)
+        ordered = self._ordered
+        if ordered is None:
+            filled, dynamic = self._filled, self.dynamic
+            ordered = self._ordered = tuple(attr for attr in self.order
+                                            if attr in filled or
+                                            attr in dynamic)
+        if not self.dynamic:
+            return iter(ordered)
+        return (attr for attr in ordered if attr not in self.dynamic or
+                getattr(self, attr) is not None)
 
     def __len__(self):
-        return sum(1 for _ in self.__iter__())
+        if not self.dynamic:
+            return len(self._filled)
+        return len(self._filled) + sum(1 for attr in self.dynamic
+                                       if getattr(self, attr) is not None)
+
+    def _fill(self, attr, val):
+        if attr.startswith('_') or attr in self.dynamic:
+            return
+        filled = self._filled
+        if val is None:
+            if attr in filled:
+                filled.discard(attr)
+                self._ordered = None
+        elif attr not in filled:
+            filled.add(attr)
+            self._ordered = None
 
     def __repr__(self):
         attrs = ', '.join('%s=%s' % (i, self.getdisplay(i)) for i in self)
@@ -468,13 +570,19 @@ class Container(MutableMapping):
     @classmethod
     def _validate(cls, attr, val=None):
         try:
-            return cls.validate(val, cls.types[attr])
+            validate = cls.validators[attr]
         except KeyError:
             return val
+        try:
+            return validate(val)
         except ValidationError, error:
             error.args = '%s: %s' % (attr, error),
             raise
 
+    @classmethod
+    def validator(cls, type):
+        return lambda val: cls.validate(val, type)
+
     @staticmethod
     def validate(val, type):
         if val is not None and type is not None and not isinstance(val, type):
@@ -485,8 +593,9 @@ class Container(MutableMapping):
         return val
 
 
-class Metadata(Container):
+class MetadataMixin(object):
 
+    __slots__ = ()
     types = TYPES
 
     @property
@@ -497,6 +606,11 @@ class Metadata(Container):
             val.seek(0, os.SEEK_SET)
             return val.read(512), self.image.size, self.image.format
 
+    def asdict(self):
+        return dict((attr, self[attr]) for attr in self
+                    if self.types[attr] != IMAGE or
+                    isinstance(self[attr], LazyImage))
+
     @property
     def rounded_volume(self):
         if self.volume:
@@ -563,7 +677,7 @@ class Metadata(Container):
             return repr(val)
 
     def __eq__(self, other):
-        if not isinstance(other, Metadata):
+        if not isinstance(other, MetadataMixin):
             return NotImplemented
         try:
             self.compare(self, other)
@@ -577,10 +691,6 @@ class Metadata(Container):
             return result
         return not result
 
-    @staticmethod
-    def validate(val, type):
-        raise ValidationError('read-only')
-
     @classmethod
     def compare(cls, x, y):
         for attr, type in cls.types.iteritems():
@@ -596,6 +706,63 @@ class Metadata(Container):
                 raise ValidationError('%s: %r != %r' % (attr, xval, yval))
 
 
+class Metadata(MetadataMixin, Container):
+
+    @staticmethod
+    def validate(val, type):
+        raise ValidationError('read-only')
+
+
+class MetadataRecord(MetadataMixin):
+
+    __slots__ = tuple(TYPES) + ('format',)
+    order = tuple(sorted(attr for attr in TYPES if not attr.startswith('_')))
+
+    def __init__(self, tags=(), format=None):
+        object.__setattr__(self, 'format', format)
+        for attr in tags:
+            val = tags[attr]
+            if val is not None:
+                object.__setattr__(self, attr, val)
+
+    def __getattr__(self, attr):
+        if attr in self.types:
+            return None
+        raise AttributeError(attr)
+
+    def __setattr__(self, attr, val):
+        raise ValidationError('%s: read-only' % attr)
+
+    def __delattr__(self, attr):
+        raise ValidationError('%s: read-only' % attr)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __iter__(self):
+        return (attr for attr in self.order
+                if getattr(self, attr) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self.__iter__())
+
+    def __reduce__(self):
+        return type(self), (dict(self.iteritems()), self.format)
+
+    __hash__ = None
+    __repr__ = Container.__dict__['__repr__']
+    __contains__ = Mapping.__dict__['__contains__']
+    get = Mapping.__dict__['get']
+    keys = Mapping.__dict__['keys']
+    items = Mapping.__dict__['items']
+    values = Mapping.__dict__['values']
+    iterkeys = Mapping.__dict__['iterkeys']
+    iteritems = Mapping.__dict__['iteritems']
+    itervalues = Mapping.__dict__['itervalues']
+
+Mapping.register(MetadataRecord)
+
+
 class Open(object):
 
     def __init__(self, file, mode='rb', close=True):
@@ -629,29 +796,258 @@ class Open(object):
             self.fp.close()
 
 
+class MappedFile(object):
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.map = MemoryMap(fp.fileno(), 0, access=ACCESS_READ)
+        self.size = len(self.map)
+        self.pos = fp.tell()
+
+    @property
+    def name(self):
+        return self.fp.name
+
+    @property
+    def closed(self):
+        return self.fp.closed
+
+    def read(self, size=-1):
+        start = self.pos
+        if size < 0 or start + size > self.size:
+            end = self.size
+        else:
+            end = start + size
+        if start >= end:
+            return ''
+        self.pos = end
+        return self.map[start:end]
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        if pos < 0:
+            raise IOError(22, 'Invalid argument')
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def unpack(self, struct):
+        val = struct.unpack_from(self.map, self.pos)
+        self.pos += struct.size
+        return val
+
+    def close(self):
+        self.map.close()
+
+
+class CountedFile(object):
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.written = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.written += len(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.fp, attr)
+
+
+class LazyImage(object):
+
+    def __init__(self, file, offset, length, mime=None, ptype=3, data=None):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.mime = mime
+        self.ptype = ptype
+        self.data = data
+        self.decoded = None
+
+    @property
+    def format(self):
+        try:
+            return IMAGE_FORMATS[self.mime]
+        except KeyError:
+            return self.image.format
+
+    @property
+    def image(self):
+        if self.decoded is None:
+            self.decoded = Image.open(StringIO(self.read()))
+            self.decoded.load()
+        return self.decoded
+
+    @property
+    def datasize(self):
+        if self.data is None:
+            return self.length
+        return len(self.data)
+
+    def read(self):
+        if self.data is None:
+            with Open(self.file, 'rb') as fp:
+                fp.seek(self.offset, os.SEEK_SET)
+                self.data = fp.read(self.length)
+        return self.data
+
+    def verify(self, head=''):
+        if not PIL:
+            raise ValidationError('PIL required for image support')
+        if self.data is not None:
+            head = self.data
+        try:
+            try:
+                Image.open(StringIO(head))
+            except IOError:
+                if len(head) >= self.length:
+                    raise
+                Image.open(StringIO(self.read()))
+        except IOError, error:
+            raise ValidationError(error)
+
+    def write(self, fp):
+        if self.data is not None:
+            fp.write(self.data)
+            return
+        with Open(self.file, 'rb') as src:
+            Decoder.copyfile(src, fp, self.offset, self.offset + self.length)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.image, attr)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['decoded'] = None
+        if self.file is not None:
+            state['data'] = None
+        return state
+
+
+class GenreRegistry(object):
+
+    ref_re = re.compile(r'\((\d+|RX|CR)\)')
+    special = {'RX': u'Remix', 'CR': u'Cover'}
+
+    def __init__(self, names):
+        self.names = dict((id, unicode(name)) for id, name in enumerate(names))
+        self.ids = dict((name.lower(), id) for id, name in enumerate(names))
+
+    def id(self, name):
+        try:
+            return self.ids[name.lower()]
+        except (AttributeError, KeyError):
+            return None
+
+    def name(self, id):
+        return self.names.get(id)
+
+    def parse(self, vals):
+        genres = []
+        for val in vals:
+            if val.isdigit():
+                val = u'(%s)' % val
+            elif val in self.special:
+                val = u'(%s)' % val
+            pos = 0
+            while not val.startswith('((', pos):
+                match = self.ref_re.match(val, pos)
+                if match is None:
+                    break
+                ref = match.group(1)
+                if ref in self.special:
+                    genres.append(self.special[ref])
+                elif int(ref) in self.names:
+                    genres.append(self.names[int(ref)])
+                pos = match.end()
+            val = val[pos:]
+            if val.startswith('(('):
+                val = val[1:]
+            if val.strip():
+                genres.append(val)
+        return [genre for i, genre in enumerate(genres)
+                if genre not in genres[:i]]
+
+genre_registry = GenreRegistry(GENRES)
+
+
+class Padding(object):
+
+    def __init__(self, fixed=0, percent=0, align=None):
+        self.fixed = fixed
+        self.percent = percent
+        self.align = align
+
+    def __call__(self, size):
+        padding = self.fixed + int(size * self.percent / 100.0)
+        if self.align:
+            padding += -(size + padding) % self.align
+        return padding
+
+    def __repr__(self):
+        return '%s(fixed=%r, percent=%r, align=%r)' % (
+                type(self).__name__, self.fixed, self.percent, self.align)
+
+
 class Decoder(Metadata):
 
     format = None
     editable = False
+    magic = None
+    extensions = ()
+    fallback = False
+    layout = ()
+    strategy = None
 
     uint32be = Struct('> L')
     int16be = Struct('> h')
     uint16be = Struct('> H')
     uint32le = Struct('< L')
 
-    def __init__(self, file):
+    def __init__(self, file, mmap=False, scan_audio=True, fields=None):
+        self.scan_audio = scan_audio
+        if fields is None:
+            self.fields = self.wanted = None
+        else:
+            self.fields = frozenset(fields)
+            for attr in self.fields:
+                if attr not in self.types or attr.startswith('_'):
+                    raise ValidationError('%s: unknown field' % attr)
+            self.wanted = self.fields.union(FIELD_SOURCES[attr]
+                                            for attr in self.fields
+                                            if attr in FIELD_SOURCES)
         if self.editable:
             mode = 'rb+'
             close = False
         else:
             mode = 'rb'
             close = True
+        if isinstance(file, basestring):
+            self.path = os.path.abspath(file)
+        else:
+            self.path = None
         with Open(file, mode, close) as fp:
             self.fp = fp
+            if mmap:
+                try:
+                    self.fp = MappedFile(fp)
+                except (AttributeError, EnvironmentError, ValueError):
+                    pass
             try:
                 self.decode()
             except Errors, error:
                 raise InvalidMedia, error, sys.exc_traceback
+            finally:
+                if self.fp is not fp:
+                    self.fp.close()
+                    self.fp = fp
         self.modified = False
 
     def save(self, *args, **kwargs):
@@ -659,12 +1055,32 @@ class Decoder(Metadata):
             raise EncodeError('encoding not formatted for %s' % self.format)
         if self.fp.closed:
             raise EncodeError('original file has closed')
+        if self.fields is not None:
+            raise EncodeError('cannot encode a partial decode')
+        strategy = kwargs.pop('strategy', 'auto')
+        if strategy not in ('auto', 'inplace', 'rewrite'):
+            raise EncodeError('unknown strategy: %r' % strategy)
+        self.finish_decode()
+        if strategy == 'rewrite':
+            return strategy, self.rewrite(*args, **kwargs)
         kwargs['inplace'] = True
-        self.encode(self.fp, *args, **kwargs)
+        fp = CountedFile(self.fp)
+        self.strategy = strategy
+        try:
+            written = self.encode(fp, *args, **kwargs)
+        finally:
+            self.strategy = None
+        if written is not None:
+            return 'rewrite', written
+        self.fp.flush()
+        return 'inplace', fp.written
 
     def dump(self, file=None, *args, **kwargs):
+        if self.fields is not None:
+            raise EncodeError('cannot encode a partial decode')
         if file is None:
             file = StringIO()
+        self.finish_decode()
         with Open(file, 'wb') as fp:
             kwargs['inplace'] = False
             self.encode(fp, *args, **kwargs)
@@ -674,16 +1090,120 @@ class Decoder(Metadata):
     def dumps(self, *args, **kwargs):
         return self.dump(None, *args, **kwargs).getvalue()
 
+    def rewrite(self, *args, **kwargs):
+        if self.strategy == 'inplace':
+            raise EncodeError('tag does not fit in place')
+        kwargs['inplace'] = False
+        if kwargs.get('padding') is None:
+            kwargs['padding'] = Padding(DEFAULT_PADDING, REWRITE_PERCENT,
+                                        BLOCKSIZE)
+        if self.path is None:
+            tmp = TemporaryFile()
+            try:
+                self.encode(tmp, *args, **kwargs)
+                tmp.seek(0, os.SEEK_SET)
+                new = type(self)(tmp)
+                self.fp.seek(0, os.SEEK_SET)
+                self.copyfile(tmp, self.fp, 0)
+                written = self.fp.tell()
+                self.fp.truncate()
+                self.fp.flush()
+            finally:
+                tmp.close()
+        else:
+            written, new = self.replace(*args, **kwargs)
+        for attr in self.layout:
+            setattr(self, attr, getattr(new, attr))
+        return written
+
+    def replace(self, *args, **kwargs):
+        path = os.path.realpath(self.path)
+        dir, name = os.path.split(path)
+        fd, tmp = mkstemp(prefix='.%s.' % name, dir=dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                self.encode(fp, *args, **kwargs)
+                fp.flush()
+                os.fsync(fp.fileno())
+                written = fp.tell()
+            with open(tmp, 'rb') as fp:
+                new = type(self)(fp)
+            os.chmod(tmp, os.stat(path).st_mode & 07777)
+            os.rename(tmp, path)
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        try:
+            fd = os.open(dir, os.O_RDONLY)
+        except OSError:
+            pass
+        else:
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        self.fp.close()
+        self.fp = open(self.path, 'rb+')
+        return written, new
+
+    @staticmethod
+    def getpadding(padding, size):
+        if padding is None:
+            padding = DEFAULT_PADDING
+        elif callable(padding):
+            padding = padding(size)
+        if padding < 0:
+            raise EncodeError('invalid padding: %r' % padding)
+        return padding
+
+    def wants(self, attr):
+        return self.wanted is None or attr in self.wanted
+
+    def __iter__(self):
+        attrs = super(Decoder, self).__iter__()
+        if self.fields is None:
+            return attrs
+        return (attr for attr in attrs if attr in self.fields)
+
+    def __len__(self):
+        if self.fields is None:
+            return super(Decoder, self).__len__()
+        return sum(1 for attr in self)
+
+    def finish_decode(self):
+        if not self.scan_audio:
+            self.scan_audio = True
+            try:
+                self.decode_audio()
+            except:
+                self.scan_audio = False
+                raise
+
+    def getlayout(self):
+        return dict((attr, getattr(self, attr)) for attr in self.layout)
+
     def unpack(self, struct):
-        val = struct.unpack(self.fp.read(struct.size))
+        if isinstance(self.fp, MappedFile):
+            val = self.fp.unpack(struct)
+        else:
+            val = struct.unpack(self.fp.read(struct.size))
         if len(val) == 1:
             return val[0]
         return val
 
     def __setattr__(self, attr, val):
-        super(Decoder, self).__setattr__(attr, val)
         if attr in self.types:
-            self.modified = True
+            val = self._validate(attr, val)
+            object.__setattr__(self, attr, val)
+            object.__setattr__(self, 'modified', True)
+            self._fill(attr, val)
+        else:
+            object.__setattr__(self, attr, val)
 
     def __delattr__(self, attr):
         super(Decoder, self).__delattr__(attr)
@@ -694,112 +1214,182 @@ class Decoder(Metadata):
     def decode():
         raise NotImplementedError
 
+    def decode_audio(self):
+        pass
+
     @staticmethod
     def encode(fp, *args, **kwargs):
         raise NotImplementedError
 
     @classmethod
     def validate(cls, val, type):
+        return cls.typevalidators[type](val)
+
+    @classmethod
+    def validator(cls, type):
+        if type in (DICT, IDICT):
+            return cls.validate_dict
+        elif type == TEXT:
+            return cls.validate_text
+        elif type == GENRE:
+            return cls.validate_genre
+        elif type == BOOL:
+            return cls.validate_bool
+        elif type == IMAGE:
+            return cls.validate_image
+        elif type == UINT16:
+            return cls.uint_validator(0xffff, 'uint16')
+        elif type == UINT32:
+            return cls.uint_validator(0xffffffff, 'uint32')
+        elif type == VOLUME:
+            return cls.validate_volume
+        elif type == UINT16X2:
+            return cls.validate_uint16x2
+        raise TypeError('unknown type: %r' % type)
+
+    @staticmethod
+    def cleantext(val):
+        if isinstance(val, str):
+            val = val.decode('ascii', 'ignore')
+        if isinstance(val, unicode):
+            val = val.replace('\x00', '').strip()
+        return val
+
+    @staticmethod
+    def validate_dict(val):
+        if val is not None and not isinstance(val, dict):
+            raise ValidationError('must be a dictionary')
+        return val
+
+    @classmethod
+    def validate_text(cls, val):
         if val is None:
             return
-        if type in (DICT, IDICT) and not isinstance(val, dict):
-            raise ValidationError('must be a dictionary')
-        elif type == GENRE:
-            if isinstance(val, (int, long)):
-                try:
-                    val = GENRES[val]
-                except IndexError, error:
-                    raise ValidationError(error)
-            type = TEXT
-        if type == TEXT and not isinstance(val, basestring):
+        if not isinstance(val, basestring):
             val = str(val)
-        if type in (TEXT, UINT16, BOOL, UINT16X2, GENRE, UINT32, VOLUME):
-            if isinstance(val, str):
-                val = val.decode('ascii', 'ignore')
+        return cls.cleantext(val) or None
+
+    @classmethod
+    def validate_genre(cls, val):
+        if isinstance(val, (int, long)):
+            id, val = val, genre_registry.name(val)
+            if val is None:
+                raise ValidationError('unknown genre id: %d' % id)
+        return cls.validate_text(val)
+
+    @classmethod
+    def validate_bool(cls, val):
+        if val is None:
+            return
+        val = cls.cleantext(val)
+        if isinstance(val, unicode):
+            if not val:
+                return
+            val = val.lower()
+        try:
+            return BOOLEAN_VALUES[val] or None
+        except (KeyError, TypeError):
+            raise ValidationError('invalid boolean')
+
+    @staticmethod
+    def validate_image(val):
+        if val is None:
+            return
+        if not PIL:
+            raise ValidationError('PIL required for image support')
+        if not isinstance(val, (ImageFile, LazyImage)):
+            try:
+                with Open(val, 'rb') as fp:
+                    val = Image.open(fp)
+                    val.load()
+            except (TypeError, IOError), error:
+                raise ValidationError(error)
+        return val or None
+
+    @classmethod
+    def uint_validator(cls, maximum, name):
+        cleantext = cls.cleantext
+        message = 'out of range of %s' % name
+
+        def validate(val):
+            if val is None:
+                return
+            val = cleantext(val)
             if isinstance(val, unicode):
-                val = val.replace('\x00', '').strip()
                 if not val:
                     return
-                if type in (UINT16, UINT32):
-                    try:
-                        val = int(val)
-                    except ValueError, error:
-                        raise ValidationError(error)
-                elif type == VOLUME:
-                    try:
-                        val = float(val)
-                    except ValueError, error:
-                        raise ValidationError(error)
-                elif type == BOOL:
-                    val = val.lower()
-        if type == BOOL:
-            for bool, vals in BOOLEANS.iteritems():
-                if val in vals:
-                    val =  bool
-                    break
-            else:
-                raise ValidationError('invalid boolean')
-        elif type == IMAGE:
-            if not PIL:
-                raise ValidationError('PIL required for image support')
-            if not isinstance(val, ImageFile):
                 try:
-                    with Open(val, 'rb') as fp:
-                        val = Image.open(fp)
-                        val.load()
-                except (TypeError, IOError), error:
+                    val = int(val)
+                except ValueError, error:
                     raise ValidationError(error)
-        elif type in (UINT16, UINT32):
             if isinstance(val, float):
                 val = int(val)
             elif not isinstance(val, (int, long)):
                 raise ValidationError('must be an integer')
-        elif type == VOLUME:
-            if isinstance(val, int):
+            if val < 0 or val > maximum:
+                raise ValidationError(message)
+            return val or None
+
+        return validate
+
+    @classmethod
+    def validate_volume(cls, val):
+        if val is None:
+            return
+        val = cls.cleantext(val)
+        if isinstance(val, unicode):
+            if not val:
+                return
+            try:
                 val = float(val)
-            elif not isinstance(val, float):
-                raise ValidatinError('must be a float')
-            if val < -99.9:
-                val = -99.9
-            elif val > 100.0:
-                val = 100.0
-        if type == UINT16 and (val < 0 or val > 0xffff):
-            raise ValidationError('out of range of uint16')
-        elif type == UINT16X2:
-            if isinstance(val, (int, long)):
-                val = val, 0
-            elif isinstance(val, unicode):
-                val = val.split('/')
-            if isinstance(val, tuple):
-                val = list(val)
-            elif not isinstance(val, list):
-                raise ValidationError('invalid type for uint16x2')
+            except ValueError, error:
+                raise ValidationError(error)
+        if isinstance(val, int):
+            val = float(val)
+        elif not isinstance(val, float):
+            raise ValidationError('must be a float')
+        if val < -99.9:
+            val = -99.9
+        elif val > 100.0:
+            val = 100.0
+        return val or None
+
+    @classmethod
+    def validate_uint16x2(cls, val):
+        if val is None:
+            return
+        val = cls.cleantext(val)
+        if isinstance(val, (int, long)):
+            val = val, 0
+        elif isinstance(val, unicode):
             if not val:
-                val = [0, 0]
-            elif len(val) == 1:
-                val.append(0)
-            elif len(val) != 2:
-                raise ValidationError('needs one or two members')
-            for i, item in enumerate(val):
-                if isinstance(item, basestring):
-                    try:
-                        item = int(item)
-                    except ValueError:
-                        item = 0
-                elif not isinstance(item, (int, long)):
-                    raise ValidationError('each member must be a number')
-                if item < 0:
+                return
+            val = val.split('/')
+        if isinstance(val, tuple):
+            val = list(val)
+        elif not isinstance(val, list):
+            raise ValidationError('invalid type for uint16x2')
+        if not val:
+            val = [0, 0]
+        elif len(val) == 1:
+            val.append(0)
+        elif len(val) != 2:
+            raise ValidationError('needs one or two members')
+        for i, item in enumerate(val):
+            if isinstance(item, basestring):
+                try:
+                    item = int(item)
+                except ValueError:
                     item = 0
-                elif item > 0xffff:
-                    raise ValidationError('member out of range of uint16')
-                val[i] = item
-            if val == [0, 0]:
-                val = None
-        elif type == UINT32 and (val < 0 or val > 0xffffffff):
-            raise ValidationError('out of range of uint32')
-        if not val and type not in (DICT, IDICT):
-            val = None
-        return val
+            elif not isinstance(item, (int, long)):
+                raise ValidationError('each member must be a number')
+            if item < 0:
+                item = 0
+            elif item > 0xffff:
+                raise ValidationError('member out of range of uint16')
+            val[i] = item
+        if val != [0, 0]:
+            return val
 
     @staticmethod
     def copyfile(src, dst, pos=None, end=None, blocksize=None):
@@ -809,15 +1399,26 @@ class Decoder(Metadata):
             src.seek(0, os.SEEK_END)
             end = src.tell()
         if blocksize is None:
-            blocksize = BLOCKSIZE
+            blocksize = COPYSIZE
         left = end - pos
         src.seek(pos, os.SEEK_SET)
+        if not hasattr(src, 'readinto'):
+            while left:
+                data = src.read(left if blocksize > left else blocksize)
+                if not data:
+                    break
+                dst.write(data)
+                left -= len(data)
+            return
+        buf = bytearray(left if blocksize > left else blocksize)
         while left:
-            data = src.read(left if blocksize > left else blocksize)
-            if not data:
+            if left < len(buf):
+                buf = bytearray(left)
+            size = src.readinto(buf)
+            if not size:
                 break
-            dst.write(data)
-            left -= len(data)
+            dst.write(buffer(buf, 0, size))
+            left -= size
 
 
 class MP3Frame(Container):
@@ -832,16 +1433,22 @@ class MP3(Decoder):
 
     format = 'mp3'
     editable = True
+    magic = re.compile(r'^(?:ID3|\xff[\xe0-\xff])')
+    extensions = ('.mp3',)
+    fallback = True
+    layout = ('hasid3v1', 'id3v1start', 'id3v1end', 'hasid3v2', 'id3v2start',
+              'id3v2end', 'id3v2version', 'id3v2unsync', 'hasmp3', 'mp3start',
+              'mp3end')
 
     id3v1 = Struct('3s 30s 30s 30s 4s 30s B')
     id3v2head = Struct('3s B B B 4s')
     longbytes = Struct('4B')
+    unsync_re = re.compile(r'\xff(?=[\x00\xe0-\xff]|\Z)')
 
-    tag_re = re.compile(r'^[A-Z0-9 ]{3,4}$')
-    genre_re = re.compile(r'^\((\d+)\)$')
     track_re = re.compile(r'^(.+)\x00 ([^\x00])$')
 
     fakemp3 = '\xff\xf2\x14\x00' * 7
+    framelens = None
 
     def __init__(self, *args, **kwargs):
         self.hasid3v1 = False
@@ -851,9 +1458,11 @@ class MP3(Decoder):
         self.id3v2start = None
         self.id3v2end = None
         self.id3v2version = None
+        self.id3v2unsync = None
         self.hasmp3 = False
         self.mp3start = None
         self.mp3end = None
+        self.mp3pending = None
         super(MP3, self).__init__(*args, **kwargs)
 
     def get_gapless(self):
@@ -947,33 +1556,97 @@ class MP3(Decoder):
 
     @property
     def mp3frames(self):
-        if self.hasmp3:
-            self.fp.seek(self.mp3start, os.SEEK_SET)
-            hsize = self.uint32be.size
-            size = 0
-            while True:
-                head = self.fp.read(hsize)
-                try:
-                    flen = self.mp3framelen(head)
-                    frame = head + self.fp.read(flen - hsize)
-                    size += len(frame)
-                    yield frame
-                except Errors:
+        index = self.mp3index
+        if index:
+            self.fp.seek(index[0], os.SEEK_SET)
+            for pos, end in zip(index, index[1:].tolist() + [self.mp3end]):
+                yield self.fp.read(end - pos)
+
+    @property
+    def mp3index(self):
+        index = array('L')
+        if not self.hasmp3:
+            return index
+        framelens = self.getframelens()
+        unpack = self.uint32be.unpack_from
+        hsize = self.uint32be.size
+        pos = base = self.mp3start
+        data = ''
+        while True:
+            i = pos - base
+            if i + hsize > len(data):
+                self.fp.seek(pos, os.SEEK_SET)
+                data = self.fp.read(MP3_SCANSIZE)
+                base = pos
+                i = 0
+                if len(data) < hsize:
                     break
-            self.mp3end = self.mp3start + size
+            val = unpack(data, i)[0]
+            if val & 0xffe00000 != 0xffe00000:
+                break
+            size = framelens[(val >> 9) & 0xfff]
+            if not size:
+                break
+            index.append(pos)
+            pos += size
+        self.fp.seek(0, os.SEEK_END)
+        self.mp3end = min(pos, self.fp.tell())
+        return index
 
     def decode(self):
-        try:
-            self.decode_id3v1()
-        except Errors:
-            pass
+        if self.scan_audio and self.fields is None:
+            try:
+                self.decode_id3v1()
+            except Errors:
+                pass
+            try:
+                self.decode_id3v2()
+            except Errors:
+                pass
+            self.decode_mp3()
+            return
         try:
             self.decode_id3v2()
         except Errors:
             pass
-        self.decode_mp3()
+        keep = [attr for attr in ID3V1_ATTRS
+                if self[attr] is not None or not self.wants(attr)]
+        if len(keep) < len(ID3V1_ATTRS):
+            try:
+                self.decode_id3v1(keep)
+            except Errors:
+                pass
+        else:
+            self.hasid3v1 = None
+        if self.hasid3v2 and not self.scan_audio and self.hasframes(
+                self.id3v2end):
+            self.mp3pending = self.id3v2end
+        else:
+            self.decode_mp3()
 
-    def decode_id3v1(self):
+    def hasframes(self, pos):
+        self.fp.seek(pos, os.SEEK_SET)
+        head = self.fp.read(self.uint32be.size)
+        if len(head) < self.uint32be.size:
+            return False
+        size = self.framelen(head)
+        if not size:
+            return False
+        self.fp.seek(pos + size, os.SEEK_SET)
+        head = self.fp.read(self.uint32be.size)
+        return len(head) == self.uint32be.size and bool(self.framelen(head))
+
+    def decode_audio(self):
+        if self.hasid3v1 is None:
+            try:
+                self.decode_id3v1(ID3V1_ATTRS)
+            except Errors:
+                pass
+        if self.mp3pending is not None:
+            self.decode_mp3(self.mp3pending)
+            self.mp3pending = None
+
+    def decode_id3v1(self, keep=()):
         try:
             self.fp.seek(self.id3v1.size * -1, os.SEEK_END)
             tag = self.unpack(self.id3v1)
@@ -983,20 +1656,29 @@ class MP3(Decoder):
             self.id3v1end = self.fp.tell()
             self.id3v1start = self.id3v1end - self.id3v1.size
             try:
-                self.name, self.artist, self.album, self.year = tag[1:5]
+                for attr, val in zip(('name', 'artist', 'album', 'year'),
+                                     tag[1:5]):
+                    if attr not in keep and self.wants(attr):
+                        self[attr] = val
             except ValidationError:
                 pass
             if tag[5][28] == '\x00' and tag[5][29] != '\x00':
-                self.comment = tag[5][:28]
-                self.track = ord(tag[5][29])
+                comment, track = tag[5][:28], ord(tag[5][29])
             else:
                 try:
                     comment, track = self.track_re.search(tag[5]).groups()
-                    self.comment = comment
-                    self.track = ord(track)
+                    track = ord(track)
                 except AttributeError:
-                    self.comment = tag[5]
-            self.genre = tag[6]
+                    comment, track = tag[5], None
+            if 'comment' not in keep and self.wants('comment'):
+                self.comment = comment
+            if (track is not None and 'track' not in keep and
+                self.wants('track')):
+                self.track = track
+            genre = genre_registry.name(tag[6])
+            if (genre is not None and 'genre' not in keep and
+                self.wants('genre')):
+                self.genre = genre
         except Errors:
             self.hasid3v1 = False
             self.id3v1start = None
@@ -1019,22 +1701,72 @@ class MP3(Decoder):
             self.id3v2start = pos
             tagsize = self.getint(head[4], syncsafe=True)
             self.id3v2end = pos + self.id3v2head.size + tagsize
-            self.id3v2version = head[1]
-            while tagsize >= opts['head'].size:
-                tag, size, flags = self.unpack(opts['head'])
-                if not self.tag_re.search(tag):
+            self.id3v2version = version = head[1]
+            self.id3v2unsync = unsync = bool(head[3] & 0x80)
+            base = pos + self.id3v2head.size
+            fhead, syncsafe = opts['head'], opts['syncsafe']
+            whole = unsync and version < 4
+            if whole:
+                data = self.resync(self.fp.read(tagsize))
+                tagsize = len(data)
+            else:
+                data = self.fp.read(min(tagsize, ID3V2_READSIZE))
+            start = offset = 0
+            while tagsize - offset >= fhead.size:
+                if offset + fhead.size > start + len(data):
+                    self.fp.seek(base + offset, os.SEEK_SET)
+                    data = self.fp.read(min(tagsize - offset, ID3V2_READSIZE))
+                    start = offset
+                tag, size, flags = fhead.unpack_from(data, offset - start)
+                if (tag not in ID3V2_FRAMEIDS and
+                    tag.translate(None, ID3V2_IDCHARS)):
                     break
-                size = self.getint(size, opts['syncsafe'])
-                tagsize -= (opts['head'].size + size)
-                val = self.fp.read(size)
-                try:
-                    attr = ID3V2_TAGS[tag]
-                except KeyError:
+                size = self.getint(size, syncsafe)
+                offset += fhead.size
+                i, j = offset - start, offset - start + size
+                offset += size
+                attr = ID3V2_TAGS.get(tag, '_unknown')
+                if not self.wants(attr):
+                    continue
+                type = self.types[attr]
+                fmt = 0
+                if version == 4:
+                    fmt = ord(flags[1]) & 0x03 | (0x02 if unsync else 0)
+                if type == IDICT and not fmt:
+                    try:
+                        self.set_image(*self.getimage(
+                                tag, size, base + offset - size, data[i:j],
+                                lazy=not whole))
+                    except ValidationError:
+                        pass
+                    continue
+                if whole or j <= len(data):
+                    val = data[i:j]
+                else:
+                    self.fp.seek(base + offset - size, os.SEEK_SET)
+                    val = self.fp.read(size)
+                if fmt & 0x01:
+                    val = val[4:]
+                if fmt & 0x02:
+                    val = self.resync(val)
+                    self.id3v2unsync = True
+                if type == IDICT:
+                    try:
+                        self.set_image(*self.getimage(
+                                tag, len(val), None, val, lazy=False))
+                    except ValidationError:
+                        pass
+                    continue
+                if attr == '_unknown':
                     tags = self.__dict__.setdefault('_unknown', {})
                     tags.setdefault(tag, []).append(val)
                     continue
-                type = self.types[attr]
-                if type in (BOOL, GENRE, TEXT, UINT16, UINT16X2, UINT32):
+                if type == GENRE:
+                    val = genre_registry.parse(self.getstrs(val))
+                    if not val:
+                        continue
+                    val = val[0]
+                elif type in (BOOL, TEXT, UINT16, UINT16X2, UINT32):
                     val = self.getstr(val)
                     if not val:
                         continue
@@ -1049,25 +1781,6 @@ class MP3(Decoder):
                     except ValidationError:
                         pass
                     continue
-                elif type == GENRE:
-                    try:
-                        val = int(self.genre_re.search(val).group(1))
-                    except AttributeError:
-                        pass
-                elif type == IDICT:
-                    ebyte, val, encoding, term = self.getenc(val)
-                    if tag == 'PIC':
-                        val = val[3:]
-                    else:
-                        val = self.splitstr(val, offset=1)[1]
-                    ptype = ord(val[0])
-                    key, val = self.splitstr(val[1:], term, offset=1)
-                    try:
-                        self.set_image(StringIO(val),
-                                       self.getstr(ebyte + key), ptype)
-                    except ValidationError:
-                        pass
-                    continue
                 elif type == VOLUME:
                     if tag == 'RVA2':
                         val = self.splitstr(val, offset=1)[1][1:3]
@@ -1093,8 +1806,41 @@ class MP3(Decoder):
             self.id3v2start = None
             self.id3v2end = None
             self.id3v2version = None
+            self.id3v2unsync = None
             raise
 
+    def getimage(self, tag, size, pos=None, head='', lazy=True):
+        if pos is None:
+            pos = self.fp.tell()
+        path = self.path if lazy else None
+        if path is None:
+            limit = size
+        else:
+            limit = min(size, BLOCKSIZE)
+        if len(head) < limit:
+            self.fp.seek(pos + len(head), os.SEEK_SET)
+            head += self.fp.read(limit - len(head))
+        while True:
+            ebyte, val, encoding, term = self.getenc(head)
+            if tag == 'PIC':
+                mime = IMAGE_MIMETYPES.get(val[:3].upper())
+                val = val[3:]
+            else:
+                mime, val = self.splitstr(val, offset=1)
+                mime = mime.rstrip('\x00').lower() or None
+            ptype = ord(val[0])
+            key, val = self.splitstr(val[1:], term, offset=1)
+            if val or len(head) >= size:
+                break
+            self.fp.seek(pos + len(head), os.SEEK_SET)
+            head += self.fp.read(size - len(head))
+        offset = len(head) - len(val)
+        self.fp.seek(pos + size, os.SEEK_SET)
+        image = LazyImage(path, pos + offset, size - offset, mime, ptype,
+                          None if path else val)
+        image.verify(val)
+        return image, self.getstr(ebyte + key), ptype
+
     def decode_mp3(self, pos=None, samplesize=None):
         if pos is None:
             pos = self.id3v2end
@@ -1105,20 +1851,18 @@ class MP3(Decoder):
         try:
             self.fp.seek(pos, os.SEEK_SET)
             sample = self.fp.read(samplesize)
+            end = len(sample) - self.uint32be.size
             i = 0
             while True:
                 i = sample.find('\xff', i)
-                if i == -1:
+                if i == -1 or i > end:
                     raise DecodeError('no mp3 frame found')
-                try:
-                    j = i + self.mp3framelen(sample[i:i + self.uint32be.size])
-                    self.mp3framelen(sample[j:j + self.uint32be.size])
+                size = self.framelen(sample, i)
+                if size and i + size <= end and self.framelen(sample, i + size):
                     self.hasmp3 = True
                     self.mp3start = pos + i
                     self.mp3end = None
                     break
-                except Errors:
-                    pass
                 i += 1
         except Errors:
             self.hasmp3 = False
@@ -1126,19 +1870,30 @@ class MP3(Decoder):
             self.mp3end = None
             raise
 
+    def rewrite(self, *args, **kwargs):
+        moves = kwargs['moves'] = []
+        written = super(MP3, self).rewrite(*args, **kwargs)
+        for image, offset in moves:
+            image.offset = offset
+        return written
+
     def encode(self, fp, inplace=False, version=None, unknown=False,
                padding=None, doid3v1=True, doid3v2=True, domp3=True,
-               fakemp3=False):
+               fakemp3=False, unsync=False, moves=None):
         if inplace and not self.hasid3v2:
             doid3v2 = False
-        if doid3v2:
-            self.encode_id3v2(fp, inplace, version, unknown, padding, doid3v2)
+        if doid3v2 and not self.encode_id3v2(fp, inplace, version, unknown,
+                                             padding, doid3v2, unsync, moves):
+            return self.rewrite(version=version, unknown=unknown,
+                                padding=padding, doid3v1=doid3v1,
+                                unsync=unsync)
         if domp3 and not inplace:
             if fakemp3:
                 fp.write(self.fakemp3)
             elif self.hasmp3:
-                for frame in self.mp3frames:
-                    fp.write(frame)
+                if self.mp3end is None:
+                    self.mp3index
+                self.copyfile(self.fp, fp, self.mp3start, self.mp3end)
         if doid3v1:
             self.encode_id3v1(fp, inplace)
 
@@ -1167,16 +1922,16 @@ class MP3(Decoder):
             comment = self.pad(self.comment, 28) + '\x00' + chr(self.track[0])
         else:
             comment = self.pad(self.comment)
-        try:
-            genre = GENRES.index(self.genre)
-        except ValueError:
+        genre = genre_registry.id(self.genre)
+        if genre is None:
             genre = 255
         tag = self.id3v1.pack('TAG', self.pad(self.name),
                               self.pad(self.artist), self.pad(self.album),
                               self.pad(self.year, 4), comment, genre)
         fp.write(tag)
 
-    def encode_id3v2(self, fp, inplace, version, unknown, padding, doid3v2):
+    def encode_id3v2(self, fp, inplace, version, unknown, padding, doid3v2,
+                     unsync=False, moves=None):
         if version is None:
             version = self.id3v2version
             if version is None:
@@ -1192,28 +1947,74 @@ class MP3(Decoder):
         head = opts['head'].unpack('\x00' * opts['head'].size)
         ssize = len(head[1]) * -1
         flags = head[2]
+        applied = False
         frames = []
-        for tag, val in self.id3v2frames(opts, unknown):
-            size = self.getbytes(len(val), opts['syncsafe'])[ssize:]
-            frames += [tag, size, flags, val]
-        data = ''.join(frames)
-        size = len(data)
+        placed = []
+        size = 0
+        for tag, val, image in self.id3v2frames(opts, unknown):
+            if image is not None and unsync:
+                val += image.read()
+                image.file = None
+                image = None
+            fflags = flags
+            if unsync and version == 4:
+                val, synced = self.unsynchronise(val)
+                if synced:
+                    applied = True
+                    fflags = '\x00\x02'
+            length = len(val)
+            if image is not None:
+                length += image.datasize
+            val = (tag + self.getbytes(length, opts['syncsafe'])[ssize:] +
+                   fflags + val)
+            size += len(val)
+            frames.append((val, image))
+            if image is not None:
+                placed.append((image, self.id3v2head.size + size))
+                size += image.datasize
+        if unsync and version < 4:
+            data, applied = self.unsynchronise(
+                    ''.join(val for val, image in frames))
+            frames = [(data, None)]
+            size = len(data)
+        if self.path is None:
+            placed = []
+        else:
+            placed = [(image, offset) for image, offset in placed
+                      if image.file == self.path]
         if inplace:
             padding = (self.id3v2end - self.id3v2start -
                        size - self.id3v2head.size)
             if padding < 0:
-                raise EncodeError('no room for id3v2 tag')
+                return False
+            for image, offset in placed:
+                if self.id3v2start + offset > image.offset:
+                    image.read()
             fp.seek(self.id3v2start, os.SEEK_SET)
+            start = self.id3v2start
         else:
             if not size:
-                return
-            if padding is None:
-                padding = DEFAULT_PADDING
+                return True
+            padding = self.getpadding(padding, size + self.id3v2head.size)
+            start = fp.tell()
         size += padding
-        fp.write(self.id3v2head.pack('ID3', version, 0, 0,
+        tagflags = 0x80 if applied and version < 4 else 0
+        fp.write(self.id3v2head.pack('ID3', version, 0, tagflags,
                                      self.getbytes(size, syncsafe=True)))
-        fp.write(data)
+        for val, image in frames:
+            fp.write(val)
+            if image is not None:
+                if inplace:
+                    fp.flush()
+                image.write(fp)
         fp.write('\x00' * padding)
+        if inplace:
+            self.id3v2unsync = applied
+            for image, offset in placed:
+                image.offset = start + offset
+        elif moves is not None:
+            moves.extend((image, start + offset) for image, offset in placed)
+        return True
 
     def id3v2frames(self, opts, unknown=False):
         for tag, attr in opts['tags'].iteritems():
@@ -1233,13 +2034,12 @@ class MP3(Decoder):
                         key, val = key2, self.mkstr(val, utf16=True, term=False)
                     else:
                         key, val = self.mkstr(key, utf16=True), val2
-                    yield tag, key[0] + lang + key[1:] + val[1:]
+                    yield tag, key[0] + lang + key[1:] + val[1:], None
                 continue
             elif type == GENRE:
-                try:
-                    val = u'(%d)' % GENRES.index(val)
-                except ValueError:
-                    pass
+                id = genre_registry.id(val)
+                if id is not None:
+                    val = u'(%d)' % id
             elif type == IDICT:
                 for key, val in val.iteritems():
                     key = self.mkstr(key[0])
@@ -1251,10 +2051,13 @@ class MP3(Decoder):
                             fmt = image.format[:3]
                     else:
                         fmt = 'image/%s\x00' % image.format.lower()
-                    val = StringIO()
-                    image.save(val, image.format)
-                    yield tag, (key[0] + fmt + chr(ptype) +
-                                key[1:] + val.getvalue())
+                    val = key[0] + fmt + chr(ptype) + key[1:]
+                    if isinstance(image, LazyImage):
+                        yield tag, val, image
+                        continue
+                    data = StringIO()
+                    image.save(data, image.format)
+                    yield tag, val + data.getvalue(), None
                 continue
             elif type == UINT16:
                 val = unicode(val)
@@ -1277,7 +2080,7 @@ class MP3(Decoder):
             if isinstance(val, unicode):
                 val = self.mkstr(val, term=False)
             if isinstance(val, str):
-                yield tag, val
+                yield tag, val, None
 
     @staticmethod
     def pad(val, size=30):
@@ -1308,30 +2111,47 @@ class MP3(Decoder):
 
     @classmethod
     def getint(cls, bytes, syncsafe=False):
-        val = cls.uint32be.unpack(
-                '\x00' * (cls.uint32be.size - len(bytes)) + bytes)[0]
+        if len(bytes) != cls.longbytes.size:
+            bytes = '\x00' * (cls.longbytes.size - len(bytes)) + bytes
         if syncsafe:
-            return (((val & 0x0000007f) >> 0) | ((val & 0x00007f00) >> 1) |
-                    ((val & 0x007f0000) >> 2) | ((val & 0x7f000000) >> 3) )
-        return val
+            a, b, c, d = cls.longbytes.unpack(bytes)
+            return (ID3V2_SYNCSAFE[0][a] | ID3V2_SYNCSAFE[1][b] |
+                    ID3V2_SYNCSAFE[2][c] | ID3V2_SYNCSAFE[3][d])
+        return cls.uint32be.unpack(bytes)[0]
 
     @classmethod
     def getbytes(cls, val, syncsafe=False):
-        bytes = cls.uint32be.pack(val)
         if syncsafe:
-            vals = cls.longbytes.unpack(bytes)
-            bytes = cls.longbytes.pack(
-                    ((vals[1] >> 5) & 0x07) | (vals[0] << 3) & 0x7f,
-                    ((vals[2] >> 6) & 0x03) | (vals[1] << 2) & 0x7f,
-                    ((vals[3] >> 7) & 0x01) | (vals[2] << 1) & 0x7f,
-                    ((vals[3] >> 0) & 0x7f))
-        return bytes
+            return cls.longbytes.pack(val >> 21 & 0x7f, val >> 14 & 0x7f,
+                                      val >> 7 & 0x7f, val & 0x7f)
+        return cls.uint32be.pack(val)
+
+    @classmethod
+    def unsynchronise(cls, data):
+        if '\xff' not in data:
+            return data, False
+        synced = cls.unsync_re.sub('\xff\x00', data)
+        return synced, len(synced) != len(data)
+
+    @staticmethod
+    def resync(data):
+        return data.replace('\xff\x00', '\xff')
 
     @classmethod
     def getstr(cls, val):
         ebyte, val, encoding, term = cls.getenc(val)
         return cls.splitstr(val, term)[0].decode(encoding, 'ignore')
 
+    @classmethod
+    def getstrs(cls, val):
+        ebyte, val, encoding, term = cls.getenc(val)
+        vals = []
+        while val:
+            item, val = cls.splitstr(val, term)
+            vals.append(item.decode(encoding, 'ignore'))
+            val = val[len(term):]
+        return vals
+
     @staticmethod
     def mkstr(val, utf16=False, term=True):
         if val is None:
@@ -1362,10 +2182,31 @@ class MP3(Decoder):
 
     @classmethod
     def mp3framelen(cls, bytes):
-        frame = cls.decode_mp3frame(cls.uint32be.unpack(bytes)[0])
+        size = cls.framelen(bytes)
+        if not size:
+            raise DecodeError('invalid frame')
+        return size
+
+    @classmethod
+    def framelen(cls, data, pos=0):
+        val = cls.uint32be.unpack_from(data, pos)[0]
+        if val & 0xffe00000 != 0xffe00000:
+            return 0
+        return cls.getframelens()[(val >> 9) & 0xfff]
+
+    @classmethod
+    def getframelens(cls):
+        if MP3.framelens is None:
+            MP3.framelens = array('H', (cls.calcframelen(0xffe00000 | i << 9)
+                                        for i in xrange(4096)))
+        return MP3.framelens
+
+    @classmethod
+    def calcframelen(cls, val):
+        frame = cls.decode_mp3frame(val)
         if (not frame.sync or frame.version == 1 or frame.layer == 4 or
             frame.bitrate in (-1, 14) or frame.srate == 3):
-            raise DecodeError('invalid frame')
+            return 0
         bitrate = MP3_BITRATES[
                 (3 if frame.layer == 1 else 4) if frame.v2
                 else (frame.layer - 1)][frame.bitrate]
@@ -1401,15 +2242,20 @@ class IFF(MP3):
 
     format = 'iff'
     editable = True
+    magic = re.compile(r'^(?:RIFF|FORM|LIST|CAT )')
+    extensions = ('.wav', '.aif', '.aiff', '.aifc')
+    fallback = False
 
     riff = Struct('< 4s L')
     aiff = Struct('> 4s L')
 
     def decode(self, pos=None, end=None, fmt=None):
-        try:
-            self.decode_id3v1()
-        except Errors:
-            pass
+        top = pos is None
+        if self.fields is None:
+            try:
+                self.decode_id3v1()
+            except Errors:
+                pass
         if pos is None:
             pos = 0
         if end is None:
@@ -1431,30 +2277,59 @@ class IFF(MP3):
             if id in ('RIFF', 'FORM', 'LIST', 'CAT '):
                 self.decode(pos + 4, pos + size, fmt)
             elif id in IFFIDS:
-                try:
-                    self[IFFIDS[id]] = self.fp.read(size)
-                except ValidationError:
-                    pass
+                if self.wants(IFFIDS[id]):
+                    try:
+                        self[IFFIDS[id]] = self.fp.read(size)
+                    except ValidationError:
+                        pass
             elif id == 'ID3 ':
                 try:
                     self.decode_id3v2(pos)
                 except Errors:
                     pass
             elif id == 'data':
-                try:
-                    self.decode_mp3(pos)
-                except Errors:
-                    pass
+                if self.scan_audio:
+                    try:
+                        self.decode_mp3(pos)
+                    except Errors:
+                        pass
+                else:
+                    self.mp3pending = pos
             pos += size + size % 2
+        if top and self.fields is not None:
+            try:
+                self.decode_id3v1([attr for attr in ID3V1_ATTRS
+                                   if self[attr] is not None])
+            except Errors:
+                pass
+
+    def decode_audio(self):
+        try:
+            super(IFF, self).decode_audio()
+        except Errors:
+            self.mp3pending = None
+
+    def rewrite(self, *args, **kwargs):
+        raise EncodeError('iff files can only be saved in place')
 
 
 class M4A(Decoder):
 
     format = 'm4a'
-    editable = False
+    editable = True
+    magic = re.compile(r'^.{4}ftyp', re.DOTALL)
+    extensions = ('.m4a', '.m4b', '.m4p', '.m4v', '.mp4')
 
     head = Struct('> L 4s')
+    datahead = Struct('> L 4s L')
     uint16bex2 = Struct('> 2H')
+    uint64be = Struct('> Q')
+
+    imagetypes = {13: 'image/jpeg', 14: 'image/png', 27: 'image/bmp'}
+    imageflags = dict((mime, flags) for flags, mime in imagetypes.iteritems())
+    ilstpath = ('moov', 'udta', 'meta', 'ilst')
+    containers = ('trak', 'mdia', 'minf', 'stbl')
+    hdlr = '\x00\x00\x00\x21hdlr' + '\x00' * 8 + 'mdirappl' + '\x00' * 9
 
     def decode(self, pos=None, end=None, base=None, ftyp=False):
         if pos is None:
@@ -1467,6 +2342,12 @@ class M4A(Decoder):
         while pos < end:
             self.fp.seek(pos, os.SEEK_SET)
             size, id = self.unpack(self.head)
+            skip = self.head.size
+            if size == 1:
+                size = self.unpack(self.uint64be)
+                skip += self.uint64be.size
+            elif size == 0:
+                size = end - pos
             path = base + [id]
             tag = '.'.join(path)
             if not ftyp:
@@ -1475,22 +2356,34 @@ class M4A(Decoder):
                 ftyp = True
             atom, attr = ATOMS.get(tag, (None, None))
             if atom == ATOM_NODE1:
-                self.decode(pos + 8, pos + size, path, ftyp)
+                self.decode(pos + skip, pos + size, path, ftyp)
             elif atom == ATOM_NODE2:
-                self.decode(pos + 12, pos + size, path, ftyp)
-            elif atom == ATOM_DATA:
-                self.fp.seek(pos + 24)
-                val = self.fp.read(size - 24)
+                self.decode(pos + skip + 4, pos + size, path, ftyp)
+            elif atom == ATOM_DATA and self.wants(attr):
                 type = self.types[attr]
+                if type == IMAGE:
+                    self.fp.seek(pos + 8)
+                    dsize, id, flags = self.unpack(self.datahead)
+                    self.fp.seek(pos + 24)
+                    if self.path is None:
+                        data = head = self.fp.read(dsize - 16)
+                    else:
+                        data = None
+                        head = self.fp.read(min(dsize - 16, BLOCKSIZE))
+                    val = LazyImage(self.path, pos + 24, dsize - 16,
+                                    self.imagetypes.get(flags & 0xffffff),
+                                    data=data)
+                else:
+                    self.fp.seek(pos + 24)
+                    val = self.fp.read(size - 24)
                 if type == BOOL:
                     val = ord(val)
                 elif type == GENRE:
                     if tag == 'moov.udta.meta.ilst.gnre':
-                        val = self.uint16be.unpack(val)[0] - 1
+                        val = genre_registry.name(
+                                self.uint16be.unpack(val)[0] - 1)
                     else:
                         val = val.decode('utf-8', 'ignore')
-                elif type == IMAGE:
-                    val = StringIO(val)
                 elif type == TEXT:
                     val = val.decode('utf-8', 'ignore')
                 elif type == UINT16:
@@ -1501,6 +2394,8 @@ class M4A(Decoder):
                 elif type == UINT32:
                     val = self.uint32be.unpack(val)[0]
                 try:
+                    if type == IMAGE:
+                        val.verify(head)
                     self[attr] = val
                 except ValidationError:
                     pass
@@ -1508,9 +2403,188 @@ class M4A(Decoder):
                 break
             pos += size
 
+    def encode(self, fp, inplace=False, padding=None):
+        atoms = self.toplevel()
+        for i, (pos, size, id) in enumerate(atoms):
+            if id == 'moov':
+                break
+        else:
+            raise EncodeError('no moov atom')
+        self.fp.seek(pos, os.SEEK_SET)
+        data = self.fp.read(size)
+        if self.head.unpack_from(data)[0] == 1:
+            data = self.mkatom('moov', data[self.head.size +
+                                            self.uint64be.size:])
+        length = len(data)
+        items = self.ilstitems()
+        if inplace:
+            free = 0
+            for apos, asize, aid in atoms[i + 1:]:
+                if aid not in ('free', 'skip'):
+                    break
+                free += asize
+            else:
+                moov = self.rebuild(data, 0, length, 0, items, padding)
+                fp.seek(pos, os.SEEK_SET)
+                fp.write(moov)
+                fp.truncate()
+                return
+            moov = self.rebuild(data, 0, length, 0, items, 0)
+            slack = size + free - len(moov)
+            if slack >= self.head.size:
+                moov = self.rebuild(data, 0, length, 0, items, slack)
+            if len(moov) != size + free:
+                return self.rewrite(padding=padding)
+            fp.seek(pos, os.SEEK_SET)
+            fp.write(moov)
+            return
+        moov = self.rebuild(data, 0, length, 0, items, padding)
+        if len(moov) != size:
+            moov = bytearray(moov)
+            self.patchoffsets(moov, self.head.size, len(moov), pos + size,
+                              len(moov) - size)
+        self.copyfile(self.fp, fp, 0, pos)
+        fp.write(str(moov))
+        self.copyfile(self.fp, fp, pos + size)
+
+    def toplevel(self):
+        self.fp.seek(0, os.SEEK_END)
+        end = self.fp.tell()
+        atoms = []
+        pos = 0
+        while pos + self.head.size <= end:
+            self.fp.seek(pos, os.SEEK_SET)
+            size, id = self.unpack(self.head)
+            if size == 1:
+                size = self.unpack(self.uint64be)
+            elif size == 0:
+                size = end - pos
+            if size < self.head.size:
+                raise EncodeError('invalid atom size')
+            atoms.append((pos, size, id))
+            pos += size
+        return atoms
+
+    def children(self, data, pos, end):
+        while pos + self.head.size <= end:
+            size, id = self.head.unpack_from(data, pos)
+            if size in (0, 1):
+                raise EncodeError('unsupported %s atom size: %d' % (id, size))
+            if size < self.head.size or pos + size > end:
+                size = end - pos
+            yield pos, size, id
+            pos += size
+
+    def rebuild(self, data, pos, size, depth, items, padding):
+        id = self.ilstpath[depth]
+        if id == 'ilst':
+            atom = self.mkilst(data[pos + 8:pos + size], items)
+            padding = self.getpadding(padding, len(atom))
+            if padding >= self.head.size:
+                atom += self.mkatom('free', '\x00' * (padding - 8))
+            return atom
+        skip = 12 if id == 'meta' else 8
+        child = self.ilstpath[depth + 1]
+        body = []
+        found = merge = False
+        for cpos, csize, cid in self.children(data, pos + skip, pos + size):
+            if cid == child and not found:
+                body.append(self.rebuild(data, cpos, csize, depth + 1, items,
+                                         padding))
+                found = True
+                merge = child == 'ilst'
+            elif merge and cid in ('free', 'skip'):
+                continue
+            else:
+                body.append(data[cpos:cpos + csize])
+                merge = False
+        if not found:
+            if child == 'meta':
+                new = self.mkatom(child, '\x00' * 4 + self.hdlr)
+            else:
+                new = self.mkatom(child, '')
+            body.append(self.rebuild(new, 0, len(new), depth + 1, items,
+                                     padding))
+        return self.mkatom(id, data[pos + 8:pos + skip] + ''.join(body))
+
+    def mkilst(self, data, items):
+        items = items.copy()
+        body = []
+        for pos, size, id in self.children(data, 0, len(data)):
+            if 'moov.udta.meta.ilst.' + id in ATOMS:
+                if id in items:
+                    body.append(items.pop(id))
+            else:
+                body.append(data[pos:pos + size])
+        body.extend(items[id] for id in sorted(items))
+        return self.mkatom('ilst', ''.join(body))
+
+    def ilstitems(self):
+        items = {}
+        for path, (atom, attr) in ATOMS.iteritems():
+            val = self[attr] if atom == ATOM_DATA else None
+            if val is None:
+                continue
+            id = path.rsplit('.', 1)[1]
+            type = self.types[attr]
+            flags = 21
+            if type == GENRE:
+                genre = genre_registry.id(val)
+                if (id == 'gnre') != (genre is not None):
+                    continue
+                if id == 'gnre':
+                    flags, val = 0, self.uint16be.pack(genre + 1)
+                else:
+                    flags, val = 1, val.encode('utf-8')
+            elif type == IMAGE:
+                if isinstance(val, LazyImage):
+                    mime, data = val.mime, val.read()
+                else:
+                    data = StringIO()
+                    val.save(data, val.format)
+                    mime, data = 'image/%s' % val.format.lower(), data.getvalue()
+                flags, val = self.imageflags.get(mime, 0), data
+            elif type == BOOL:
+                val = chr(val)
+            elif type == UINT16X2:
+                flags, val = 0, '\x00\x00' + self.uint16bex2.pack(*val)
+                if id == 'trkn':
+                    val += '\x00\x00'
+            elif type == UINT16 and id == 'tmpo':
+                val = self.uint16be.pack(val)
+            elif type == UINT32:
+                val = self.uint32be.pack(val)
+            else:
+                flags, val = 1, unicode(val).encode('utf-8')
+            data = self.datahead.pack(16 + len(val), 'data', flags)
+            items[id] = self.mkatom(id, data + '\x00' * 4 + val)
+        return items
+
+    def mkatom(self, id, data):
+        size = len(data) + self.head.size
+        if size > 0xffffffff:
+            raise EncodeError('%s atom too large' % id)
+        return self.head.pack(size, id) + data
+
+    def patchoffsets(self, data, pos, end, threshold, delta):
+        for pos, size, id in self.children(data, pos, end):
+            if id in self.containers:
+                self.patchoffsets(data, pos + 8, pos + size, threshold, delta)
+            elif id in ('stco', 'co64'):
+                count = self.uint32be.unpack_from(data, pos + 12)[0]
+                offsets = Struct('> %d%s' % (count, 'L' if id == 'stco'
+                                                    else 'Q'))
+                vals = [val + delta if val >= threshold else val
+                        for val in offsets.unpack_from(data, pos + 16)]
+                if id == 'stco' and vals and max(vals) > 0xffffffff:
+                    raise EncodeError('chunk offsets overflow stco')
+                offsets.pack_into(data, pos + 16, *vals)
+
 
 class Vorbis(Decoder):
 
+    layout = ('tagstart', 'tagend')
+
     def __init__(self, *args, **kwargs):
         self.tagstart = None
         self.tagend = None
@@ -1518,9 +2592,22 @@ class Vorbis(Decoder):
 
     def decode(self):
         self.tagstart = self.fp.tell()
-        self.encoder = self.getstr()
+        if self.wants('encoder'):
+            self.encoder = self.getstr()
+        else:
+            self.fp.seek(self.getint(), os.SEEK_CUR)
         for i in xrange(self.getint()):
-            tag, val = self.getstr().split('=', 1)
+            size = self.getint()
+            if self.fields is None:
+                data = self.fp.read(size)
+            else:
+                data = self.fp.read(min(size, VORBIS_KEYSIZE))
+                if '=' in data and not self.wants(VORBISTAGS.get(
+                        data.split('=', 1)[0].lower().strip())):
+                    self.fp.seek(size - len(data), os.SEEK_CUR)
+                    continue
+                data += self.fp.read(size - len(data))
+            tag, val = data.decode('utf-8', 'ignore').split('=', 1)
             try:
                 attr = VORBISTAGS[tag.lower().strip()]
             except KeyError:
@@ -1551,6 +2638,9 @@ class FLAC(Vorbis):
 
     format = 'flac'
     editable = True
+    magic = re.compile(r'^fLaC')
+    extensions = ('.flac',)
+    layout = Vorbis.layout + ('blocks',)
 
     head = Struct('B 3s')
 
@@ -1574,37 +2664,96 @@ class FLAC(Vorbis):
             self.blocks.append((pos, size, head))
             if head & 127 == 4:
                 super(FLAC, self).decode()
-            if head & 128:
+            if head & 128 or head & 127 == 4 and self.fields is not None:
                 break
             pos += size
 
-    def encode(self, fp, inplace=False):
+    def encode(self, fp, inplace=False, padding=None):
+        tag = StringIO()
+        super(FLAC, self).encode(tag)
+        tag = tag.getvalue()
+        if len(tag) >= 1 << 24:
+            raise EncodeError('vorbis comment block too large')
+        if inplace:
+            if not self.encode_inplace(fp, tag):
+                return self.rewrite(padding=padding)
+            return
+        blocks = self.blocks
+        if not [block for block in blocks if block[2] & 127 == 4]:
+            pos, size, head = blocks[0]
+            blocks = [(pos, size, head & 127), (None, 0, 4 | head & 128)]
+            blocks += self.blocks[1:]
+        if padding is not None:
+            blocks = [(pos, size, head & 127) for pos, size, head in blocks
+                      if head & 127 != 1]
+            padding = self.getpadding(padding, len(tag) + self.head.size)
+            if padding:
+                types = [block[2] for block in blocks]
+                blocks.insert(types.index(4) + 1,
+                              (None, min(padding, (1 << 24) - 1), 1))
+            pos, size, head = blocks.pop()
+            blocks.append((pos, size, head | 128))
         fp.write('fLaC')
-        for pos, size, head in self.blocks:
+        for pos, size, head in blocks:
             if head & 127 == 4:
-                tag = StringIO()
-                super(FLAC, self).encode(tag)
-                data = tag.getvalue()
-                newsize = len(data)
+                data = tag
+            elif pos is None:
+                data = '\x00' * size
             else:
                 self.fp.seek(pos, os.SEEK_SET)
                 data = self.fp.read(size)
-                newsize = size
-            fp.write(self.head.pack(head, self.uint32be.pack(newsize)[1:]))
+            fp.write(self.head.pack(head, self.uint32be.pack(len(data))[1:]))
             fp.write(data)
+        pos, size, head = self.blocks[-1]
         self.copyfile(self.fp, fp, pos + size)
 
-    @staticmethod
-    def save(*args, **kwargs):
-        raise NotImplementedError
+    def encode_inplace(self, fp, tag):
+        types = [head & 127 for pos, size, head in self.blocks]
+        if 4 in types:
+            start = end = types.index(4)
+        elif 1 in types:
+            start = end = types.index(1)
+        else:
+            return False
+        while start > 1 and types[start - 1] == 1:
+            start -= 1
+        while end + 1 < len(types) and types[end + 1] == 1:
+            end += 1
+        begin = self.blocks[start][0] - self.head.size
+        pos, size, head = self.blocks[end]
+        padding = pos + size - begin - self.head.size * 2 - len(tag)
+        if padding < 0 and padding != -self.head.size or padding >= 1 << 24:
+            return False
+        blocks = [(begin + self.head.size, len(tag), 4)]
+        if padding >= 0:
+            blocks.append((begin + self.head.size * 2 + len(tag), padding, 1))
+        pos, size, last = blocks.pop()
+        blocks.append((pos, size, last | head & 128))
+        fp.seek(begin, os.SEEK_SET)
+        for pos, size, head in blocks:
+            fp.write(self.head.pack(head, self.uint32be.pack(size)[1:]))
+            if head & 127 == 4:
+                fp.write(tag)
+            else:
+                fp.write('\x00' * size)
+        self.blocks[start:end + 1] = blocks
+        return True
 
 
 class CRC(object):
 
+    word = Struct('> L')
+    rword = Struct('< L')
+
     def __init__(self, width=4, poly=0x04C11DB7, reverse=False, initial=0):
         self.bits = width * 8
+        self.poly = poly
         self.initial = initial
         self.table = []
+        self.powers = {}
+        self.bitmap = ''.join(chr(self.reflect(i, 8)) for i in xrange(256))
+        self.zlib = (zlib is not None and width == 4 and poly == 0x04C11DB7
+                     and not reverse)
         topbit = self.bitmask(self.bits - 1)
         for index in xrange(256):
             if reverse:
@@ -1620,13 +2769,48 @@ class CRC(object):
             self.table.append(r & ((((1 << (self.bits - 1)) - 1) << 1) | 1))
 
     def checksum(self, *args):
-        clear = 2 ** self.bits - 1
+        if self.zlib:
+            r = self.reflect32(self.initial) ^ 0xffffffff
+            for data in args:
+                r = zlib.crc32(data.translate(self.bitmap), r) & 0xffffffff
+            return self.reflect32(r ^ 0xffffffff)
+        table = self.table
+        mask = (1 << (self.bits - 8)) - 1
         r = self.initial
         for data in args:
-            for byte in data:
-                r = ((r << 8) ^ self.table[(r >> 24) ^ ord(byte)]) & clear
+            for byte in bytearray(data):
+                r = ((r & mask) << 8) ^ table[(r >> 24) ^ byte]
         return r
 
+    def reflect32(self, v):
+        return self.rword.unpack(self.word.pack(v).translate(self.bitmap))[0]
+
+    def multiply(self, a, b):
+        topbit = self.bitmask(self.bits - 1)
+        clear = 2 ** self.bits - 1
+        r = 0
+        for i in xrange(self.bits - 1, -1, -1):
+            if r & topbit:
+                r = ((r << 1) ^ self.poly) & clear
+            else:
+                r <<= 1
+            if b >> i & 1:
+                r ^= a
+        return r
+
+    def zeros(self, r, count):
+        try:
+            power = self.powers[count]
+        except KeyError:
+            power, square, n = 1, 1 << 8, count
+            while n:
+                if n & 1:
+                    power = self.multiply(power, square)
+                square = self.multiply(square, square)
+                n >>= 1
+            self.powers[count] = power
+        return self.multiply(r, power)
+
     @classmethod
     def reflect(cls, v, b):
         t = v
@@ -1647,6 +2831,9 @@ class OGG(Vorbis):
 
     format = 'ogg'
     editable = True
+    magic = re.compile(r'^OggS')
+    extensions = ('.ogg', '.oga')
+    layout = Vorbis.layout + ('pages',)
 
     head = Struct('< 4s 2B Q 3L B')
 
@@ -1654,13 +2841,15 @@ class OGG(Vorbis):
 
     def __init__(self, *args, **kwargs):
         self.pages = []
+        self.pagepos = None
         super(OGG, self).__init__(*args, **kwargs)
 
-    def decode(self):
+    def decode(self, pos=None):
         self.fp.seek(0, os.SEEK_END)
         end = self.fp.tell()
-        pos = 0
-        self.pages = []
+        if pos is None:
+            pos = 0
+            self.pages = []
         while pos < end:
             self.fp.seek(pos, os.SEEK_SET)
             head = self.unpack(self.head)
@@ -1669,74 +2858,442 @@ class OGG(Vorbis):
             table = self.fp.read(head[7])
             pos += self.head.size + head[7]
             start = pos
-            packets = [0]
-            last = len(table) - 1
-            for i, segment in enumerate(table):
-                segment = ord(segment)
-                packets[-1] += segment
-                if segment < 255 and i != last:
-                    packets.append(0)
+            packets = self.packetsizes(table)
+            found = False
             for i, size in enumerate(packets):
                 self.fp.seek(pos, os.SEEK_SET)
                 if self.fp.read(7) == '\x03vorbis':
-                    super(OGG, self).decode()
-                    comment = True
+                    if i == len(packets) - 1 and table.endswith('\xff'):
+                        self.decode_packet(pos + 7, size - 7)
+                    else:
+                        super(OGG, self).decode()
+                    comment = found = True
                 else:
                     comment = False
                 packets[i] = size, comment
                 pos += size
             self.pages.append((start, head, packets))
+            if found and (not self.scan_audio or self.fields is not None):
+                self.pagepos = pos
+                break
+
+    @staticmethod
+    def packetsizes(table):
+        packets = [0]
+        last = len(table) - 1
+        for i, segment in enumerate(table):
+            segment = ord(segment)
+            packets[-1] += segment
+            if segment < 255 and i != last:
+                packets.append(0)
+        return packets
+
+    def decode_packet(self, pos, size):
+        start = pos
+        data = [self.fp.read(size)]
+        while True:
+            self.fp.seek(pos + size, os.SEEK_SET)
+            head = self.unpack(self.head)
+            if head[0] != 'OggS':
+                raise DecodeError('not an ogg page')
+            table = self.fp.read(head[7])
+            pos = self.fp.tell()
+            size = 0
+            for segment in imap(ord, table):
+                size += segment
+                if segment < 255:
+                    break
+            data.append(self.fp.read(size))
+            if not table or segment < 255:
+                break
+        fp = self.fp
+        self.fp = StringIO(''.join(data))
+        try:
+            super(OGG, self).decode()
+        finally:
+            self.fp = fp
+        self.tagstart = start
+        self.tagend = None
+
+    def decode_audio(self):
+        if self.pagepos is not None:
+            self.decode(self.pagepos)
+            self.pagepos = None
 
     def encode(self, fp, inplace=False, padding=None):
-        if padding is None:
-            padding = DEFAULT_PADDING
-        for pos, head, packets in self.pages:
+        first, last, index, packets = self.getheader()
+        val = StringIO()
+        super(OGG, self).encode(val)
+        comment = '\x03vorbis' + val.getvalue() + '\x01'
+        if inplace:
+            if not self.encode_inplace(fp, first, last, index, packets,
+                                       comment):
+                return self.rewrite(padding=padding)
+            return
+        packets[index] = comment + '\x00' * self.getpadding(padding,
+                                                           len(comment))
+        serial = self.pages[first][1][4]
+        pages = self.mkpages(packets, self.pages[first][1],
+                             self.pages[last][1])
+        others = [page for page in self.pages[first:last + 1]
+                  if page[1][4] != serial]
+        delta = len(pages) - (last - first + 1 - len(others))
+        self.copyfile(self.fp, fp, 0, self.pagestart(self.pages[first]))
+        for page in pages:
+            fp.write(page)
+        for page in others:
+            self.copyfile(self.fp, fp, self.pagestart(page),
+                          self.pageend(page))
+        if delta:
+            self.copypages(fp, self.pages[last + 1:], serial, delta)
+        else:
+            self.copyfile(self.fp, fp, self.pageend(self.pages[last]))
+
+    def encode_inplace(self, fp, first, last, index, packets, comment):
+        serial = self.pages[first][1][4]
+        pages = self.pages[first:last + 1]
+        if [page for page in pages if page[1][4] != serial]:
+            return False
+        begin = self.pagestart(pages[0])
+        target = self.pageend(pages[-1]) - begin
+        sizes = [len(packet) for packet in packets]
+        sizes[index] = len(comment)
+        lo, hi = 0, target - self.pagesize(sizes)[1]
+        if hi < 0:
+            return False
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sizes[index] = len(comment) + mid
+            if self.pagesize(sizes)[1] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        sizes[index] = len(comment) + lo
+        if self.pagesize(sizes) != (len(pages), target):
+            return False
+        packets[index] = comment + '\x00' * lo
+        data = ''.join(self.mkpages(packets, pages[0][1], pages[-1][1]))
+        fp.seek(begin, os.SEEK_SET)
+        fp.write(data)
+        self.pages[first:last + 1] = self.readpages(begin, data)
+        return True
+
+    def pagesize(self, sizes):
+        segments = sum(size // 255 + 1 for size in sizes)
+        pages = (segments + 254) // 255
+        return pages, pages * self.head.size + segments + sum(sizes)
+
+    def readpages(self, pos, data):
+        pages = []
+        offset = 0
+        while offset < len(data):
+            head = self.head.unpack_from(data, offset)
+            offset += self.head.size + head[7]
+            table = data[offset - head[7]:offset]
+            start = pos + offset
+            packets = []
+            for size in self.packetsizes(table):
+                comment = data[offset:offset + 7] == '\x03vorbis'
+                packets.append((size, comment))
+                offset += size
+            pages.append((start, head, packets))
+        return pages
+
+    def getheader(self):
+        index = None
+        for first, (pos, head, packets) in enumerate(self.pages):
+            for i, packet in enumerate(packets):
+                if packet[1]:
+                    index = i
+                    break
+            if index is not None:
+                break
+        else:
+            raise EncodeError('no vorbis comment header')
+        serial = head[4]
+        if head[2] & 1 and index == 0:
+            raise EncodeError('vorbis comment header is continued')
+        pages = [(i, page) for i, page in enumerate(self.pages)
+                 if i >= first and page[1][4] == serial]
+        packets = []
+        for n, (last, (pos, head, sizes)) in enumerate(pages):
             self.fp.seek(pos, os.SEEK_SET)
-            page = []
-            for packet in packets:
-                size, comment = packet
-                if comment:
-                    val = StringIO()
-                    super(OGG, self).encode(val)
-                    data = ('\x03vorbis' + val.getvalue() +
-                            '\x01' + '\x00' * padding)
-                    self.fp.seek(size, os.SEEK_CUR)
+            for i, (size, comment) in enumerate(sizes):
+                data = self.fp.read(size)
+                if i == 0 and head[2] & 1 and packets:
+                    packets[-1] += data
                 else:
-                    data = self.fp.read(size)
-                page.append(data)
-            table = []
-            for size in (len(packet) for packet in page):
-                i, r = divmod(size, 255)
-                table.append('\xff' * i)
-                table.append(chr(r))
-            table = ''.join(table)
-            head = list(head)
-            head[6] = 0
-            head[7] = len(table)
-            head[6] = self.crc.checksum(self.head.pack(*head), table, *page)
-            fp.write(self.head.pack(*head))
-            fp.write(table)
-            for data in page:
-                fp.write(data)
+                    packets.append(data)
+            if n + 1 == len(pages) or not pages[n + 1][1][1][2] & 1:
+                if len(packets) >= index + 2:
+                    break
+        return first, last, index, packets
+
+    def mkpages(self, packets, first, last):
+        segments = []
+        for packet in packets:
+            size = len(packet)
+            for pos in xrange(0, size - size % 255 + 1, 255):
+                data = packet[pos:pos + 255]
+                segments.append((data, len(data) < 255))
+        pages = []
+        continued = first[2] & 1
+        for i in xrange(0, len(segments), 255):
+            page = segments[i:i + 255]
+            flags = continued
+            if not pages:
+                flags |= first[2] & 2
+            if i + 255 >= len(segments):
+                flags |= last[2] & 4
+                granule = last[3]
+            elif [complete for data, complete in page if complete]:
+                granule = 0
+            else:
+                granule = 0xffffffffffffffff
+            table = ''.join(chr(len(data)) for data, complete in page)
+            body = ''.join(data for data, complete in page)
+            head = [first[0], first[1], flags, granule, first[4],
+                    first[5] + len(pages), 0, len(table)]
+            head[6] = self.crc.checksum(self.head.pack(*head), table, body)
+            pages.append(self.head.pack(*head) + table + body)
+            continued = not page[-1][1]
+        return pages
+
+    def copypages(self, fp, pages, serial, delta):
+        if not pages:
+            return
+        crc, head, uint32le = self.crc, self.head, self.uint32le
+        starts = [pos - head.size - page[7] for pos, page, packets in pages]
+        starts.append(self.pageend(pages[-1]))
+        self.fp.seek(starts[0], os.SEEK_SET)
+        for i, (pos, page, packets) in enumerate(pages):
+            size = starts[i + 1] - starts[i]
+            data = self.fp.read(size)
+            if page[4] == serial:
+                page = list(page)
+                seq = (page[5] + delta) & 0xffffffff
+                diff = crc.checksum(uint32le.pack(page[5] ^ seq))
+                page[6] ^= crc.zeros(diff, size - 22)
+                page[5] = seq
+                data = head.pack(*page) + data[head.size:]
+            fp.write(data)
+
+    def pagestart(self, page):
+        return page[0] - self.head.size - page[1][7]
 
     @staticmethod
-    def save(*args, **kwargs):
-        raise NotImplementedError
+    def pageend(page):
+        return page[0] + sum(size for size, comment in page[2])
+
+
+class Dispatcher(object):
+
+    def __init__(self, decoders, samplesize=None):
+        if samplesize is None:
+            samplesize = BLOCKSIZE
+        self.decoders = decoders
+        self.samplesize = samplesize
+        self.hits = dict((cls.format, 0) for cls in decoders)
+        self.misses = dict((cls.format, 0) for cls in decoders)
+
+    def __call__(self, file, **kwargs):
+        head, ext = self.sniff(file)
+        for cls in self.candidates(head, ext):
+            try:
+                tag = cls(file, **kwargs)
+            except InvalidMedia:
+                self.misses[cls.format] += 1
+                continue
+            self.hits[cls.format] += 1
+            return tag
+        raise InvalidMedia('no suitable decoder found')
+
+    def candidates(self, head, ext=None):
+        found = [cls for cls in self.decoders
+                 if cls.magic is not None and cls.magic.search(head)]
+        if ext:
+            found.sort(key=lambda cls: ext not in cls.extensions)
+        return found + [cls for cls in self.decoders
+                        if cls.fallback and cls not in found]
+
+    def sniff(self, file):
+        if isinstance(file, (int, long)):
+            pos = os.lseek(file, 0, os.SEEK_CUR)
+            try:
+                os.lseek(file, 0, os.SEEK_SET)
+                head = os.read(file, self.samplesize)
+            finally:
+                os.lseek(file, pos, os.SEEK_SET)
+            return head, None
+        with Open(file, 'rb') as fp:
+            fp.seek(0, os.SEEK_SET)
+            head = fp.read(self.samplesize)
+            name = getattr(fp, 'name', None)
+        if isinstance(name, basestring):
+            ext = os.path.splitext(name)[1].lower()
+        else:
+            ext = None
+        return head, ext
+
+
+class Cache(object):
+
+    schema = ('CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, '
+              'size INTEGER, mtime REAL, inode INTEGER, stamp REAL, data BLOB)')
+
+    def __init__(self, file, maxsize=None, batchsize=None):
+        if sqlite3 is None:
+            raise TaglibError('sqlite3 required for caching')
+        if maxsize is None:
+            maxsize = CACHE_MAXSIZE
+        if batchsize is None:
+            batchsize = CACHE_BATCHSIZE
+        self.db = sqlite3.connect(file)
+        self.db.text_factory = str
+        self.db.execute(self.schema)
+        self.db.execute('CREATE INDEX IF NOT EXISTS stamps ON tags (stamp)')
+        self.maxsize = maxsize
+        self.batchsize = batchsize
+        self.count = self.db.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+        self.hits = []
+        self.writes = 0
 
+    def __enter__(self):
+        return self
 
-def tagopen(file, readonly=False):
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def tagopen(self, file, fields=None, compact=False, **kwargs):
+        if not isinstance(file, basestring):
+            return tagopen(file, readonly=True, fields=fields,
+                           compact=compact, **kwargs)
+        kwargs.pop('scan_audio', None)
+        path = os.path.abspath(file)
+        st = os.stat(path)
+        stat = st.st_size, st.st_mtime, st.st_ino
+        row = self.db.execute('SELECT size, mtime, inode, data FROM tags '
+                              'WHERE path = ?', (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == stat:
+            data = pickle.loads(str(row[3]))
+            self.hits.append((time.time(), path))
+            if len(self.hits) >= self.batchsize:
+                self.sync()
+        else:
+            try:
+                tag = tagopen(path, **kwargs)
+                data = tag.format, tag.asdict(), tag.getlayout()
+            except InvalidMedia:
+                data = None
+            self.put(path, stat, data, row is None)
+        if data is None:
+            raise InvalidMedia('no suitable decoder found')
+        format, tags, layout = data
+        if fields is not None:
+            tags = dict((attr, val) for attr, val in tags.iteritems()
+                        if attr in fields)
+        if compact:
+            return MetadataRecord(tags, format)
+        return Metadata(tags, format=format, **layout)
+
+    def put(self, path, stat, data, new=True):
+        self.db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?)',
+                        (path,) + stat + (time.time(), sqlite3.Binary(
+                            pickle.dumps(data, pickle.HIGHEST_PROTOCOL))))
+        if new:
+            self.count += 1
+            if self.count > self.maxsize:
+                self.evict()
+        self.writes += 1
+        if self.writes >= self.batchsize:
+            self.sync()
+
+    def touch(self):
+        if self.hits:
+            self.db.executemany('UPDATE tags SET stamp = ? WHERE path = ?',
+                                self.hits)
+            self.hits = []
+
+    def evict(self, size=None):
+        if size is None:
+            size = self.maxsize - self.maxsize / 10
+        excess = self.count - size
+        if excess > 0:
+            self.touch()
+            self.db.execute('DELETE FROM tags WHERE path IN (SELECT path FROM '
+                            'tags ORDER BY stamp LIMIT ?)', (excess,))
+            self.count -= excess
+
+    def sync(self):
+        self.touch()
+        self.db.commit()
+        self.writes = 0
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+
+def tagopen(file, readonly=False, mmap=False, scan_audio=True, fields=None,
+            cache=None, compact=False):
+    if cache is not None:
+        if not readonly:
+            raise TaglibError('cached metadata is read-only, '
+                              'use readonly=True')
+        return cache.tagopen(file, mmap=mmap, scan_audio=scan_audio,
+                             fields=fields, compact=compact)
     if readonly is None:
         readonly = DEFAULT_READONLY
-    for cls in Decoders:
+    tag = dispatcher(file, mmap=mmap, scan_audio=scan_audio, fields=fields)
+    if readonly and compact:
+        return MetadataRecord(tag, tag.format)
+    if readonly:
+        return Metadata(tag)
+    return tag
+
+
+class Scanner(object):
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def __call__(self, file):
+        result = {'file': file, 'format': None, 'tags': None,
+                  'error': None, 'exception': None}
         try:
-            tag = cls(file)
-        except InvalidMedia:
-            continue
-        if readonly:
-            return Metadata(tag)
-        return tag
-    raise InvalidMedia('no suitable decoder found')
+            tag = tagopen(file, **self.kwargs)
+            result['format'] = tag.format
+            result['tags'] = tag.asdict()
+        except Exception, error:
+            result['error'] = str(error)
+            result['exception'] = type(error).__name__
+        return result
+
+
+def scan(files, workers=None, ordered=True, chunksize=None, **kwargs):
+    scanner = Scanner(**kwargs)
+    if workers is None:
+        workers = cpu_count()
+    if workers <= 1:
+        for result in imap(scanner, files):
+            yield result
+        return
+    if chunksize is None:
+        chunksize = SCAN_CHUNKSIZE
+    pool = Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(scanner, files, chunksize)
+        else:
+            results = pool.imap_unordered(scanner, files, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 Errors = TaglibError, StructError, IOError, OSError, EOFError
 Decoders = FLAC, M4A, OGG, IFF, MP3
+dispatcher = Dispatcher(Decoders)
@@ -11,6 +11,10 @@ All errors are logged to the console and optionally to a logfile.
 
 from optparse import OptionParser
 import logging as log
+import tempfile
+import random
+import shutil
+import struct
 import time
 import sys
 import os
@@ -18,6 +22,7 @@ import os
 sys.dont_write_bytecode = True  # DOWN WITH PYC
 
 from taglib import tagopen, ValidationError, InvalidMedia, __version__, MP3
+from taglib import IFF, M4A, CRC
 
 # initialize root logger
 log.basicConfig(level=log.INFO, format='%(levelname)s> %(message)s')
@@ -142,9 +147,112 @@ def find(dir, skip_svn=True):
     log.info('finished scanning')
 
 
+def chunks(path, data=None, pos=0, end=None):
+    """Return the first bytes of every stco/co64 chunk in an mpeg4 file"""
+    if data is None:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    if end is None:
+        end = len(data)
+    samples = []
+    while pos + 8 <= end:
+        size, id = struct.unpack_from('>L4s', data, pos)
+        if size < 8:
+            break
+        if id in ('moov', 'trak', 'mdia', 'minf', 'stbl'):
+            samples += chunks(path, data, pos + 8, pos + size)
+        elif id in ('stco', 'co64'):
+            count = struct.unpack_from('>L', data, pos + 12)[0]
+            fmt = '>%d%s' % (count, 'L' if id == 'stco' else 'Q')
+            for offset in struct.unpack_from(fmt, data, pos + 16):
+                samples.append(data[offset:offset + 16])
+        pos += size
+    return samples
+
+
+def mp3data(path, tag):
+    """Return the mpeg audio of a decoded mp3"""
+    with open(path, 'rb') as fp:
+        fp.seek(tag.mp3start)
+        if tag.hasid3v1 and tag.id3v1start > tag.mp3start:
+            return fp.read(tag.id3v1start - tag.mp3start)
+        return fp.read()
+
+
+def compare(src, dst):
+    """Compare metadata and return errors if any"""
+    try:
+        src.compare(src, dst)
+    except ValidationError, error:
+        return [error]
+    return []
+
+
+def test_save(file, src):
+    """Save a scratch copy in place and by rewriting, then verify it"""
+    errors = []
+    strategies = ['inplace']
+    if not isinstance(src, IFF):
+        strategies.append('rewrite')
+    fd, scratch = tempfile.mkstemp(suffix=os.path.splitext(file)[1])
+    os.close(fd)
+    try:
+        for strategy in strategies:
+            shutil.copyfile(file, scratch)
+            try:
+                tagopen(scratch, readonly=False).save(strategy=strategy)
+            except Exception, error:
+                errors.append('could not save %s: %s' % (strategy, error))
+                continue
+            try:
+                dst = tagopen(scratch)
+            except Exception, error:
+                errors.append('could not reopen %s: %s' % (strategy, error))
+                continue
+            errors += compare(src, dst)
+            if isinstance(src, M4A):
+                if chunks(file) != chunks(scratch):
+                    errors.append('%s: chunk offsets moved' % strategy)
+            elif isinstance(src, MP3) and src.hasmp3:
+                if mp3data(file, src) != mp3data(scratch, dst):
+                    errors.append('%s: mp3 data changed' % strategy)
+    finally:
+        os.remove(scratch)
+    return errors
+
+
+def crc_bytewise(crc, *args):
+    """Reference byte loop the table and zlib checksums must match"""
+    clear = 2 ** crc.bits - 1
+    r = crc.initial
+    for data in args:
+        for byte in data:
+            r = ((r << 8) ^ crc.table[(r >> 24) ^ ord(byte)]) & clear
+    return r
+
+
+def test_crc(rounds=200):
+    """Compare the zlib and table CRC paths to the byte loop"""
+    errors = []
+    for i in xrange(rounds):
+        crc = CRC(initial=random.choice((0, random.getrandbits(32))))
+        args = [os.urandom(random.choice((0, 1, 7, 255, 4096)))
+                for j in xrange(random.randint(1, 4))]
+        expected = crc_bytewise(crc, *args)
+        crc.zlib = False
+        table = crc.checksum(*args)
+        crc.zlib = True
+        zipped = crc.checksum(*args)
+        if not expected == table == zipped:
+            errors.append('crc mismatch (initial=%#x, sizes=%r): '
+                          'bytewise=%#x table=%#x zlib=%#x' % (
+                          crc.initial, map(len, args), expected, table,
+                          zipped))
+    return errors
+
+
 def test(file, version=None, fakemp3=False):
     """Test decode/save/decode of file and return errors if any"""
-    ext = os.path.splitext(file)[1].lower()
     try:
         src = tagopen(file, readonly=False)
     except InvalidMedia:
@@ -152,22 +260,24 @@ def test(file, version=None, fakemp3=False):
     except Exception, error:
         return ['unexpected decode error: %s' % error]
     errors = []
+    if not src.editable:
+        return errors
     # actual mp3 files can be inside a RIFF container, so don't complain
-    if not isinstance(src, MP3) or not src.hasmp3:
+    if isinstance(src, MP3) and not src.hasmp3:
         return errors
+    kwargs = {}
+    if isinstance(src, MP3):
+        kwargs.update(version=version, fakemp3=fakemp3)
     try:
-        dst = src.dump(version=version, fakemp3=fakemp3)
+        dst = src.dump(**kwargs)
     except Exception, error:
         return errors + ['could not save: %s' % error]
     try:
         dst = tagopen(dst)
     except Exception, error:
         return errors + ['could not reopen: %s' % error]
-    try:
-        MP3.compare(src, dst)
-    except ValidationError, error:
-        errors.append(error)
-    return errors
+    errors += compare(src, dst)
+    return errors + test_save(file, src)
 
 
 def main(args=None):
@@ -192,6 +302,9 @@ def main(args=None):
     library = args[0]
     files_tested = files_broken = error_count = 0
     log.info('begin at %s' % time.ctime())
+    for error in test_crc():
+        error_count += 1
+        log.error(error)
     try:
         with Meter('TestLibrary', find(library)) as meter:
             for file in meter: